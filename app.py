@@ -2,56 +2,124 @@ import mimetypes
 mimetypes.add_type('application/javascript', '.js')
 mimetypes.add_type('text/css', '.css')
 
-from flask import Flask, jsonify, request, send_file, send_from_directory
+from flask import Flask, Response, jsonify, request, send_file, send_from_directory, stream_with_context
 from flask_cors import CORS
 
 import chess
 import cv2
 import io
+import multiprocessing
 import numpy as np
 import os
-from PIL import Image
 import random
-import requests
-from typing import Optional, Tuple
-from ultralytics import YOLO
+from typing import Optional
 
-from server.api import continuing_game, resuming_game
+from server.api import resuming_game
+from server.batching import InferenceScheduler
+from server.capture import CaptureRegistry
+from server.detector import load_detector
+from server.events import SSE_KEEP_ALIVE, Event, sse_message
+from server.metrics import METRICS, METRICS_MIMETYPE, board_label, time_stage
+from server.recognition import RecognitionLoop
+from server.session import Session, SessionRegistry
+from server.stream import MJPEG_MIMETYPE, JpegCache, mjpeg_stream, stream_rate, stream_variant
 from server.types import *
+from server.workers import WorkerPool
 
 # Most recently trained model.
-MODEL = YOLO('models/trained_yolo11m-v0-1-0.pt')
+# This can be swapped for an exported `.onnx` file or OpenVINO model directory
+# (see `training/export/export_model.py`) to run inference on ONNX Runtime or OpenVINO instead of PyTorch.
+MODEL_PATH = os.environ.get('MEMOCHESS_MODEL', 'models/trained_yolo11m-v0-1-0.pt')
+INFERENCE_THREADS = int(os.environ['MEMOCHESS_THREADS']) if 'MEMOCHESS_THREADS' in os.environ else None
+
+# With `MEMOCHESS_WORKERS` set, inference runs in that many worker processes (see `server/workers.py`),
+# each with `MEMOCHESS_THREADS` threads (by default, an even share of the cores) pinned to its own cores.
+INFERENCE_WORKERS = int(os.environ.get('MEMOCHESS_WORKERS', '0'))
+
+if multiprocessing.parent_process() is not None:
+    # This is a worker process importing this module again as it starts; it loads its own model.
+    MODEL = None
+elif INFERENCE_WORKERS > 0:
+    MODEL = WorkerPool(MODEL_PATH, INFERENCE_WORKERS, INFERENCE_THREADS)
+else:
+    # Frames from concurrent requests are batched together into a single forward pass.
+    MODEL = InferenceScheduler(load_detector(MODEL_PATH, threads=INFERENCE_THREADS))
+
+# Whether to record stage timings and error counts for the `/metrics` endpoint.
+METRICS.enabled = os.environ.get('MEMOCHESS_METRICS', '0') == '1'
 
 random.seed(19937)
 
 app = Flask(__name__, static_folder=os.path.join('dist'), static_url_path='/')
 CORS(app)
 
-GLOBAL_BOARD_STATE = chess.Board()
-CURRENT_MOVE_STATE = MoveState(move=None, exact=True, error=None)
-
-def get_image_capture_and_blob(webcam_ip: str):
-    cap = cv2.VideoCapture(f'http://{webcam_ip}/video')
-    if cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            _, raw_image_blob = cv2.imencode('.png', frame)
-            return raw_image_blob, frame
-    else:
-        # This branch is here to accommodate for HTTP servers
-        # that proxy a live streaming image feed,
-        # in case this app is to be tested without an IP camera.
-        try:
-            response = requests.get(f'http://{webcam_ip}/video')
-            if response.ok:
-                image_data = io.BytesIO(response.content)
-                image = Image.open(image_data)
-                frame = cv2.cvtColor(np.asarray(image), cv2.COLOR_BGR2RGB)
-                _, blob = cv2.imencode('.png', frame)
-                return blob, frame
-        except:
-            pass
-    return None
+# Whether to locate the board once and then run piece detection on a rectified crop of it,
+# rather than on every full frame.
+TWO_STAGE_INFERENCE = False
+
+# The image size and confidence threshold of piece detection on full frames.
+# Each session tracks the contents of every square across frames, and a square only changes piece
+# on a detection of at least 0.25. Lower values are faster but untested for move accuracy,
+# so check them with `benchmarks/replay.py` before changing these.
+DETECTION_IMGSZ = 640
+DETECTION_CONFIDENCE = 0.25
+
+# Whether a live board found to match an earlier position of the game is rolled back to it automatically,
+# rather than the rollback being offered to the client to confirm.
+AUTO_ROLLBACK = False
+
+# The most moves registered from a single frame, for when both players moved between two reads of the board.
+# Higher values tolerate longer gaps (and slower polling), but take longer to search.
+# From three on, the moves can often have been played in more than one order; one order is then picked,
+# and the moves are marked as inexact.
+MAX_PLIES_PER_FRAME = 2
+
+# Each physical board being notated is tracked in its own session, keyed by board id.
+# Clients that do not specify a board id all share the default session.
+SESSIONS = SessionRegistry(
+    two_stage=TWO_STAGE_INFERENCE,
+    imgsz=DETECTION_IMGSZ,
+    conf=DETECTION_CONFIDENCE,
+    auto_rollback=AUTO_ROLLBACK,
+    max_plies=MAX_PLIES_PER_FRAME)
+DEFAULT_BOARD_ID = 'default'
+
+# One persistent frame reader per webcam, shared by all endpoints.
+CAPTURES = CaptureRegistry()
+
+def get_session() -> Session:
+    return SESSIONS.get(request.args.get('board', DEFAULT_BOARD_ID), request.args.get('webcam'))
+
+# The frame shown when nothing is being captured, encoded once up front.
+PLACEHOLDER_FRAME = np.zeros([1080, 1920, 3], dtype=np.uint8)
+PLACEHOLDER_PNG = cv2.imencode('.png', PLACEHOLDER_FRAME)[1].tobytes()
+
+# The most recent JPEG of each stream variant, shared by all viewers of that stream.
+STREAM_JPEGS = JpegCache()
+
+def get_image_capture(webcam_ip: str) -> Optional[np.ndarray]:
+    if not webcam_ip:
+        return None
+    # The newest frame is taken from the persistent reader for this webcam,
+    # which is started on the first request and kept alive by subsequent ones.
+    with time_stage('capture'):
+        captured = CAPTURES.latest_frame(webcam_ip)
+    if captured is None:
+        return None
+    return captured.frame
+
+def png_response(frame: Optional[np.ndarray]):
+    if frame is None:
+        # Just send a black screen if not recording.
+        return send_file(io.BytesIO(PLACEHOLDER_PNG), mimetype='image/png')
+    with time_stage('encode-png'):
+        _, blob = cv2.imencode('.png', frame)
+    return send_file(io.BytesIO(blob.tobytes()), mimetype='image/png')
+
+# Requests for a new board once the server is tracking as many boards as it allows.
+@app.errorhandler(SessionLimitException)
+def session_limit(err: SessionLimitException):
+    return jsonify({'error': ['too-many-boards', ' '.join(err.args)]}), 503
 
 @app.route('/')
 def root():
@@ -60,114 +128,226 @@ def root():
 # This endpoint returns just the frame captured by the IP webcam.
 @app.route('/video')
 def video():
-    webcam = request.args.get('webcam')
-    image_capture = get_image_capture_and_blob(webcam)
-    if image_capture is None:
-        # Just send a black screen if not recording.
-        array = np.zeros([1080, 1920, 3], dtype=np.uint8)
-        _, array = cv2.imencode('.png', array)
-        return send_file(io.BytesIO(array.tobytes()), mimetype='image/png')
-    else:
-        blob, frame = image_capture
-        return send_file(io.BytesIO(blob.tobytes()), mimetype='image/png')
+    return png_response(get_image_capture(request.args.get('webcam')))
+
+# This endpoint streams the webcam feed as MJPEG, for use directly as an image source.
+# With `annotated=1`, the annotated image of the session's most recent inference is streamed instead.
+# `quality` (JPEG quality, in steps of 10) and `scale` (downscaling factor, in steps of 0.25),
+# and `fps` (maximum frame rate, from 1 to 30) can be tuned to trade picture quality for encoding CPU and bandwidth.
+@app.route('/stream')
+def endpoint_stream():
+    session = get_session()
+    webcam = session.webcam
+    quality, scale = stream_variant(
+        request.args.get('quality', 70, type=int), request.args.get('scale', 0.5, type=float))
+    fps = stream_rate(request.args.get('fps', 10.0, type=float))
+    annotated = request.args.get('annotated', '0') == '1'
+
+    def next_frame():
+        if annotated and session.plot is not None:
+            return session.plot_timestamp, session.plot
+        captured = CAPTURES.reader(webcam).latest(max_age=5.0) if webcam else None
+        if captured is None:
+            return 0.0, lambda: PLACEHOLDER_FRAME
+        return captured.timestamp, lambda: captured.frame
+
+    key = (session.board_id, 'annotated') if annotated else (webcam, 'live')
+    return Response(
+        mjpeg_stream(next_frame, STREAM_JPEGS, key + (quality, scale), quality, scale, fps),
+        mimetype=MJPEG_MIMETYPE)
 
 # This endpoint will attempt to find the move played from a previous position.
-# Will mutate the global state.
+# Will mutate the session state.
+# The captured frame is sent back unless `image=0` is given (e.g. when the client watches `/stream`).
 @app.route('/continue')
 def endpoint_continue():
-    global CURRENT_MOVE_STATE
-    webcam = request.args.get('webcam')
-    image_capture = get_image_capture_and_blob(webcam)
-    if image_capture is None:
-        CURRENT_MOVE_STATE = MoveState(move=None, exact=True, error='no-capture')
-        # Just send a black screen if not recording.
-        array = np.zeros([1080, 1920, 3], dtype=np.uint8)
-        _, array = cv2.imencode('.png', array)
-        return send_file(io.BytesIO(array.tobytes()), mimetype='image/png')
-    blob, frame = image_capture
-    try:
-        (move, exact), pred_image = continuing_game(GLOBAL_BOARD_STATE, MODEL, frame)
-        if move is None:
-            CURRENT_MOVE_STATE = MoveState(move=None, exact=True, error=None)
-        else:
-            CURRENT_MOVE_STATE = MoveState(move=GLOBAL_BOARD_STATE.san(move), exact=exact, error=None)
-            GLOBAL_BOARD_STATE.push(move)
-        return send_file(io.BytesIO(blob.tobytes()), mimetype='image/png')
-    except ImageConversionException as err:
-        CURRENT_MOVE_STATE = MoveState(
-            move=None, exact=True, error=['image-conversion', ' '.join(err.args)])
-    except MoveIllegalException as err:
-        CURRENT_MOVE_STATE = MoveState(
-            move=None, exact=True, error=['move-illegal', ' '.join(err.args)])
-    except MoveImpossibleException as err:
-        CURRENT_MOVE_STATE = MoveState(
-            move=None, exact=True, error=['move-impossible', ' '.join(err.args)])
-    return send_file(io.BytesIO(blob.tobytes()), mimetype='image/png')
+    session = get_session()
+    send_image = request.args.get('image', '1') != '0'
+    with board_label(session.board_id), time_stage('continue'), session.frame_slot() as free:
+        if not free:
+            # The previous frame of this board is still being read, so this request is shed.
+            return '', 429, {'Retry-After': '1'}
+        frame = get_image_capture(session.webcam)
+        if frame is None:
+            with session.lock:
+                session.set_move_state(MoveState(move=None, exact=True, error='no-capture'))
+            return png_response(None) if send_image else ('', 204)
+        with session.lock:
+            session.advance(MODEL, frame)
+        return png_response(frame) if send_image else ('', 204)
 
 @app.route('/lastmove')
 def endpoint_lastmove():
-    return jsonify({
-        'move': CURRENT_MOVE_STATE.move,
-        'exact': CURRENT_MOVE_STATE.exact,
-        'error': CURRENT_MOVE_STATE.error,
-        'fen': GLOBAL_BOARD_STATE.fen(),
-        'status': GLOBAL_BOARD_STATE.result(),
-        'repetition': GLOBAL_BOARD_STATE.is_repetition(),
-    })
+    session = get_session()
+    with session.lock:
+        board = session.board
+        move_state = session.move_state
+        return jsonify({
+            'move': move_state.move,
+            'exact': move_state.exact,
+            'error': move_state.error,
+            'gate': move_state.gate,
+            'fen': board.fen(),
+            'status': board.result(),
+            'repetition': board.is_repetition(),
+        })
 
 @app.route('/resume')
 def endpoint_resume():
-    webcam = request.args.get('webcam')
-    image_capture = get_image_capture_and_blob(webcam)
-    if image_capture is None:
-        return jsonify({'error': 'no-capture'})
-    try:
-        blob, frame = image_capture
-        match resuming_game(GLOBAL_BOARD_STATE, MODEL, frame)[0]:
-            case GameResumeOutcome.ExactMatch:
-                return jsonify({'error': None, 'exact': True})
-            case GameResumeOutcome.InexactMatch:
-                return jsonify({'error': None, 'exact': False})
-            case GameResumeOutcome.PossibleMoveMade:
-                return jsonify({'error': 'possible-move-made'})
-    except ImageConversionException:
-        return jsonify({'error': 'image-conversion'})
-    except MoveIllegalException as err:
-        return jsonify({'error': 'move-illegal-' + err.args[1]})
-    except MoveImpossibleException:
-        return jsonify({'error': 'move-impossible'})
+    session = get_session()
+    with session.frame_slot() as free:
+        if not free:
+            return jsonify({'error': 'busy'})
+        frame = get_image_capture(session.webcam)
+        if frame is None:
+            return jsonify({'error': 'no-capture'})
+        with session.lock:
+            try:
+                outcome, pred_plot = resuming_game(session.board, MODEL, frame, session.reader, session.history)
+                session.record_plot(pred_plot)
+                match outcome:
+                    case GameResumeOutcome.ExactMatch:
+                        return jsonify({'error': None, 'exact': True})
+                    case GameResumeOutcome.InexactMatch:
+                        return jsonify({'error': None, 'exact': False})
+                    case GameResumeOutcome.PossibleMoveMade:
+                        return jsonify({'error': 'possible-move-made'})
+            except ImageConversionException:
+                return jsonify({'error': 'image-conversion'})
+            except MoveIllegalException as err:
+                return jsonify({'error': 'move-illegal-' + err.args[1]})
+            except MoveImpossibleException:
+                return jsonify({'error': 'move-impossible'})
+            except EarlierPositionException as err:
+                return jsonify({'error': 'rollback-available', 'ply': err.args[1]})
+            except InferenceBusyException:
+                return jsonify({'error': 'busy'})
 
 @app.route('/undolastmove')
 def endpoint_undolastmove():
-    global GLOBAL_BOARD_STATE, CURRENT_MOVE_STATE
-    if len(GLOBAL_BOARD_STATE.move_stack) > 0:
-        GLOBAL_BOARD_STATE.pop()
-        CURRENT_MOVE_STATE = MoveState(move=None, exact=True, error=None)
-    return jsonify({'fen': GLOBAL_BOARD_STATE.fen()})
+    session = get_session()
+    with session.lock:
+        if len(session.board.move_stack) > 0:
+            session.pop()
+        return jsonify({'fen': session.board.fen()})
+
+# This endpoint takes back every move after the given ply,
+# e.g. once the live board has been found to match that earlier position.
+@app.route('/rollback')
+def endpoint_rollback():
+    session = get_session()
+    ply = request.args.get('ply', type=int)
+    with session.lock:
+        if ply is None or not 0 <= ply < len(session.board.move_stack):
+            return jsonify({'valid': False})
+        session.rollback(ply)
+        return jsonify({'valid': True, 'fen': session.board.fen(), 'moves': session.san_moves()})
 
 @app.route('/override')
 def endpoint_override():
+    session = get_session()
     uci_move = request.args.get('uci').lower()
-    try:
-        move = chess.Move.from_uci(uci_move)
-        if move in GLOBAL_BOARD_STATE.legal_moves:
-            san = GLOBAL_BOARD_STATE.san(move)
-            GLOBAL_BOARD_STATE.push(move)
-            fen = GLOBAL_BOARD_STATE.fen()
-            status = GLOBAL_BOARD_STATE.result()
-            CURRENT_MOVE_STATE = MoveState(move=san, exact=True, error=None)
-            return jsonify({'valid': True, 'san': san, 'fen': fen, 'status': status})
-        else:
+    with session.lock:
+        board = session.board
+        try:
+            move = chess.Move.from_uci(uci_move)
+            if move in board.legal_moves:
+                san = board.san(move)
+                session.push(move)
+                fen = board.fen()
+                status = board.result()
+                return jsonify({'valid': True, 'san': san, 'fen': fen, 'status': status})
+            else:
+                return jsonify({'valid': False})
+        except (AssertionError, chess.InvalidMoveError):
             return jsonify({'valid': False})
-    except (AssertionError, chess.InvalidMoveError):
-        return jsonify({'valid': False})
+
+# This endpoint starts the server-side recognition loop for a session, if it is not already running,
+# and counts the caller as one of its watchers until it calls `/unwatch`.
+# From then on, the board is read every `interval` seconds regardless of how many clients are watching,
+# and moves, positions, errors and results are published to `/events`.
+@app.route('/watch')
+def endpoint_watch():
+    session = get_session()
+    interval = request.args.get('interval', 1.0, type=float)
+    with session.lock:
+        if session.loop is None or not session.loop.is_alive():
+            session.loop = RecognitionLoop(session, MODEL, CAPTURES, interval)
+        session.loop.watchers += 1
+        watchers = session.loop.watchers
+    return jsonify({'watching': True, 'watchers': watchers})
+
+# The loop keeps running until its last watcher has called this.
+@app.route('/unwatch')
+def endpoint_unwatch():
+    session = get_session()
+    with session.lock:
+        if session.loop is not None:
+            session.loop.watchers -= 1
+            if session.loop.watchers <= 0:
+                session.stop_loop()
+        watchers = session.loop.watchers if session.loop is not None else 0
+    return jsonify({'watching': watchers > 0, 'watchers': watchers})
+
+# This endpoint streams the session's events with Server-Sent Events.
+# A reconnecting client is caught up from its last seen event id
+# (the `Last-Event-ID` header sent automatically by `EventSource`, or a `since` parameter).
+# New clients, and clients too far behind to replay, are first sent a `fen` event with the full game state.
+@app.route('/events')
+def endpoint_events():
+    session = get_session()
+    board_id = session.board_id
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None:
+        cursor = request.args.get('since', type=int)
+
+    def stream():
+        nonlocal cursor, session
+        while True:
+            events = None if cursor is None else session.events.wait(cursor, timeout=15.0)
+            # Watching a session counts as using it, so it is not evicted while clients are subscribed.
+            # Should it have been replaced anyway, the client is resynchronised with the new one.
+            try:
+                current = SESSIONS.get(board_id)
+            except SessionLimitException:
+                return
+            if current is not session:
+                session, events = current, None
+            if events is None:
+                with session.lock:
+                    cursor = session.events.last_id
+                    snapshot = session.snapshot()
+                yield sse_message(Event(cursor, 'fen', snapshot))
+            elif not events:
+                yield SSE_KEEP_ALIVE
+            else:
+                for event in events:
+                    yield sse_message(event)
+                cursor = events[-1].id
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# This endpoint exposes stage timings (per board), error counts and camera dropouts
+# in the Prometheus text format, when enabled with the `MEMOCHESS_METRICS=1` environment variable.
+@app.route('/metrics')
+def endpoint_metrics():
+    if not METRICS.enabled:
+        return 'Metrics are disabled; set MEMOCHESS_METRICS=1 to enable them.\n', 404, {'Content-Type': 'text/plain'}
+    return Response(METRICS.render(), mimetype=METRICS_MIMETYPE)
+
+# This endpoint reports the batch sizes and queue waits of the inference scheduler,
+# or the state of each process when running a worker pool.
+@app.route('/inferencestats')
+def endpoint_inferencestats():
+    return jsonify(MODEL.statistics())
 
 @app.route('/reset')
 def endpoint_reset():
-    global GLOBAL_BOARD_STATE, CURRENT_MOVE_STATE
-    GLOBAL_BOARD_STATE = chess.Board()
-    CURRENT_MOVE_STATE = MoveState(move=None, exact=True, error=None)
-    return jsonify({'fen': GLOBAL_BOARD_STATE.fen()})
+    session = get_session()
+    with session.lock:
+        session.reset()
+        return jsonify({'fen': session.board.fen()})
 
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,132 @@
+# Check of the cheap change detectors that run before the model, on a synthetic recording of a game.
+# Run from the repository root with `python -m benchmarks.change_detection`.
+#
+# Each position of the game (by default the first ten moves of a Ruy Lopez) is rendered as a top-down 1080p frame
+# with pieces drawn as discs, plus a little sensor noise. For every move, the report gives:
+# - the fraction of motion gate thumbnail pixels that changed, and the gate's decision,
+#   both on the full frame and on the board region (as used once the board has been located),
+# - how many bits of the board crop's perceptual hash flipped, as used to drop near-duplicate training images.
+# A single move must always be classed as `Inferred` by the gate (or the move would only be seen once
+# something else on the board moved), so the script exits with an error if any move is not.
+
+import argparse
+import chess
+import cv2
+import json
+import numpy as np
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+from server.gate import MotionGate, Region, changed_fraction
+from server.geometry import BoardGeometry
+from server.types import GateDecision
+from training.data_collection.auto_capture import dhash
+
+RUY_LOPEZ = ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5', 'a6', 'Ba4', 'Nf6', 'O-O', 'Be7']
+
+FRAME_SIZE = (1920, 1080)
+BOARD_PIXELS = 840
+LIGHT_SQUARE, DARK_SQUARE, TABLE = (181, 217, 240), (99, 136, 181), (60, 70, 80)
+# Disc radius of each piece type, as a fraction of the square.
+PIECE_RADII = {chess.PAWN: 0.26, chess.KNIGHT: 0.32, chess.BISHOP: 0.32,
+               chess.ROOK: 0.34, chess.QUEEN: 0.38, chess.KING: 0.40}
+
+# The board's corners in normalised image coordinates, as the model would detect them.
+def board_corners() -> np.ndarray:
+    width, height = FRAME_SIZE
+    left, top = (width - BOARD_PIXELS) / 2, (height - BOARD_PIXELS) / 2
+    right, bottom = left + BOARD_PIXELS, top + BOARD_PIXELS
+    return np.array([[left, top], [right, top], [left, bottom], [right, bottom]]) / [width, height]
+
+# Drawn with H8 at the top left, as `server/geometry.py` expects.
+def render(board: chess.Board, rng: np.random.Generator, noise: float) -> np.ndarray:
+    width, height = FRAME_SIZE
+    image = np.full((height, width, 3), TABLE, dtype=np.uint8)
+    left, top = (width - BOARD_PIXELS) // 2, (height - BOARD_PIXELS) // 2
+    step = BOARD_PIXELS / 8
+    for row in range(8):
+        for column in range(8):
+            x0, y0 = int(left + column * step), int(top + row * step)
+            x1, y1 = int(left + (column + 1) * step), int(top + (row + 1) * step)
+            colour = LIGHT_SQUARE if (row + column) % 2 == 0 else DARK_SQUARE
+            cv2.rectangle(image, (x0, y0), (x1 - 1, y1 - 1), colour, -1)
+            piece = board.piece_at((7 - column) * 8 + (7 - row))
+            if piece is not None:
+                centre = ((x0 + x1) // 2, (y0 + y1) // 2)
+                radius = int(step * PIECE_RADII[piece.piece_type])
+                fill, edge = ((235, 235, 235), (40, 40, 40)) if piece.color else ((35, 35, 35), (200, 200, 200))
+                cv2.circle(image, centre, radius, fill, -1, cv2.LINE_AA)
+                cv2.circle(image, centre, radius, edge, 2, cv2.LINE_AA)
+    if noise > 0:
+        image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+    return image
+
+# Shows the gate `before`, as the reference of its last inference, and then `after` twice
+# (as two frames of the settled board), returning the changed fraction and the gate's final decision.
+def gate_check(
+        gate: MotionGate,
+        region: Optional[Region],
+        before: np.ndarray,
+        after: List[np.ndarray]) -> Tuple[float, str]:
+    gate.clear()
+    gate.observe(before)
+    gate.record([], region)
+    reference = gate.reference
+    for frame in after:
+        decision = gate.observe(frame)
+    return changed_fraction(gate.previous, reference, gate.pixel_threshold), decision.name
+
+def check(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = np.random.default_rng(args.seed)
+    geometry = BoardGeometry()
+    geometry.homography(board_corners())
+    region = geometry.region()
+
+    gate = MotionGate()
+
+    board = chess.Board()
+    before = render(board, rng, args.noise)
+    moves: List[Dict[str, Any]] = []
+    for san in args.moves:
+        board.push_san(san)
+        after = [render(board, rng, args.noise) for _ in range(2)]
+        full_fraction, full_decision = gate_check(gate, None, before, after)
+        board_fraction, board_decision = gate_check(gate, region, before, after)
+        crop_before, crop_after = MotionGate.crop(before, region), MotionGate.crop(after[0], region)
+        moves.append({
+            'move': san,
+            'full_frame': {'changed': round(full_fraction, 5), 'decision': full_decision},
+            'board_region': {'changed': round(board_fraction, 5), 'decision': board_decision},
+            'hash_bits': (dhash(crop_before, args.hash_size) ^ dhash(crop_after, args.hash_size)).bit_count(),
+        })
+        before = after[0]
+
+    # Frames of an unchanged board that differ only by sensor noise should not count as changes.
+    still = [render(board, rng, args.noise) for _ in range(3)]
+    noise_fraction, noise_decision = gate_check(gate, region, still[0], still[1:])
+    noise_bits = (dhash(MotionGate.crop(still[0], region), args.hash_size)
+                  ^ dhash(MotionGate.crop(still[1], region), args.hash_size)).bit_count()
+
+    return {
+        'moves': moves,
+        'noise': {'changed': round(noise_fraction, 5), 'decision': noise_decision, 'hash_bits': noise_bits},
+        'missed': [m['move'] for m in moves if m['board_region']['decision'] != GateDecision.Inferred.name
+                   or m['full_frame']['decision'] != GateDecision.Inferred.name],
+        'min_hash_bits': min(m['hash_bits'] for m in moves),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that single moves get past the motion gate and image dedup.')
+    parser.add_argument('moves', nargs='*', default=RUY_LOPEZ, help='moves of the game, in SAN')
+    parser.add_argument('--noise', type=float, default=2.0, help='standard deviation of the sensor noise added')
+    parser.add_argument('--hash-size', type=int, default=32, help='side of the perceptual hash grid')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = check(args)
+    print(json.dumps(report, indent=2))
+    if report['missed'] or report['noise']['decision'] != GateDecision.Unchanged.name:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Load test of a running server, for sizing hardware before an event.
+# Start the server and a camera simulator (`demo/camera_simulator.py`), then run from the repository root, e.g.
+#
+#   python -m benchmarks.load_test --sessions 16 --seconds 120 --interval 1.0 --output load.json
+#
+# Each session is a separate board of the server, reading its own simulated camera (assigned in turn).
+# In `poll` mode, each session requests `/continue` every `--interval` seconds, as the web UI used to,
+# and the latency and status of every request are recorded (a 429 means the frame was shed because
+# the previous one was still being read). In `watch` mode, each session instead starts the server-side
+# recognition loop with `/watch` and counts the events it receives on `/events`.
+# Either way, the report (printed as JSON) includes how many moves each board had registered by the end,
+# which, compared with how many moves the simulator played, shows whether the server kept up.
+
+import argparse
+from collections import Counter
+import json
+import requests
+import threading
+import time
+from typing import Any, Dict, List
+
+from benchmarks.replay import git_revision, latency_summary
+
+def session_params(args: argparse.Namespace, n: int, cameras: int) -> Dict[str, str]:
+    return {'board': f'{args.prefix}{n}', 'webcam': f'{args.cameras}/boards/{n % cameras}'}
+
+# The number of plies played in a position, from the move counters of its FEN.
+def fen_plies(fen: str) -> int:
+    fields = fen.split()
+    return (int(fields[5]) - 1) * 2 + (fields[1] == 'b')
+
+class SessionDriver(threading.Thread):
+    def __init__(self, args: argparse.Namespace, params: Dict[str, str], deadline: float):
+        super().__init__(name=f'load-{params["board"]}', daemon=True)
+        self.args = args
+        self.params = params
+        self.deadline = deadline
+        self.http = requests.Session()
+        self.latencies: List[float] = []
+        self.statuses: Counter = Counter()
+        self.events: Counter = Counter()
+        self.failures = 0
+
+    def url(self, endpoint: str) -> str:
+        return f'http://{self.args.server}/{endpoint}'
+
+    def run(self):
+        if self.args.mode == 'poll':
+            self.poll()
+        else:
+            self.watch()
+
+    def poll(self):
+        params = dict(self.params, image='0')
+        while (started := time.monotonic()) < self.deadline:
+            try:
+                response = self.http.get(self.url('continue'), params=params, timeout=self.args.timeout)
+                self.latencies.append(time.monotonic() - started)
+                self.statuses[response.status_code] += 1
+            except requests.RequestException:
+                self.failures += 1
+            time.sleep(max(0.0, self.args.interval - (time.monotonic() - started)))
+
+    def watch(self):
+        params = dict(self.params, interval=self.args.interval)
+        self.http.get(self.url('watch'), params=params, timeout=self.args.timeout)
+        try:
+            with self.http.get(self.url('events'), params=self.params, stream=True,
+                               timeout=(self.args.timeout, 20.0)) as response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith('event:'):
+                        self.events[line[len('event:'):].strip()] += 1
+                    if time.monotonic() >= self.deadline:
+                        break
+        except requests.RequestException:
+            self.failures += 1
+        finally:
+            self.http.get(self.url('unwatch'), params=self.params, timeout=self.args.timeout)
+
+    def plies(self) -> int:
+        response = self.http.get(self.url('lastmove'), params=self.params, timeout=self.args.timeout)
+        return fen_plies(response.json()['fen'])
+
+def load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    cameras = requests.get(f'http://{args.cameras}/', timeout=args.timeout).json()['boards']
+    all_params = [session_params(args, n, cameras) for n in range(args.sessions)]
+    for params in all_params:
+        requests.get(f'http://{args.server}/reset', params=params, timeout=args.timeout)
+
+    start = time.monotonic()
+    deadline = start + args.seconds
+    drivers = [SessionDriver(args, params, deadline) for params in all_params]
+    for driver in drivers:
+        driver.start()
+        # Sessions start spread over one interval, rather than all polling in lockstep.
+        time.sleep(args.interval / len(drivers))
+    for driver in drivers:
+        driver.join(timeout=args.seconds + 30.0)
+    elapsed = time.monotonic() - start
+
+    latencies = [latency for driver in drivers for latency in driver.latencies]
+    statuses = sum((driver.statuses for driver in drivers), Counter())
+    events = sum((driver.events for driver in drivers), Counter())
+    plies = [driver.plies() for driver in drivers]
+    return {
+        'revision': git_revision(),
+        'server': args.server,
+        'mode': args.mode,
+        'sessions': args.sessions,
+        'cameras': cameras,
+        'interval_s': args.interval,
+        'elapsed_s': elapsed,
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': latency_summary(latencies),
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'events': dict(events),
+        'failures': sum(driver.failures for driver in drivers),
+        'plies': {'min': min(plies), 'mean': sum(plies) / len(plies), 'max': max(plies)},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive concurrent board sessions against a running server.')
+    parser.add_argument('--server', default='localhost:5000', help='address of the server under test')
+    parser.add_argument('--cameras', default='localhost:6173', help='address of the camera simulator')
+    parser.add_argument('--sessions', type=int, default=8, help='concurrent boards')
+    parser.add_argument('--seconds', type=float, default=60.0, help='how long to run for')
+    parser.add_argument('--mode', choices=['poll', 'watch'], default='poll')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between frames of each board')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds before a request is abandoned')
+    parser.add_argument('--prefix', default='load-', help='prefix of the board ids used')
+    parser.add_argument('--output', default=None, help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    report = load_test(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
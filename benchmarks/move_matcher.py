@@ -0,0 +1,205 @@
+# Micro-benchmark of the move matcher in `server/state.py`.
+# Run from the repository root with `python -m benchmarks.move_matcher`.
+#
+# Positions are sampled from random games, and for each position a handful of
+# simulated detections are generated (exact, colour-only, occupancy-only and noisy readings).
+# Every reading is matched by both the original list-based matcher and the bitboard matcher,
+# and the results (or raised exceptions) are checked to be identical before timings are reported.
+
+import argparse
+import chess
+import json
+import random
+import time
+from typing import Callable, List, Optional, Tuple
+
+from server.state import (
+    colour_list, find_valid_move, full_occupancy, move_index, piece_list, sqn, MOVE_INDEX_CACHE)
+from server.types import MoveImpossibleException
+
+Reading = List[Optional[chess.Piece]]
+
+# The original list-based matcher, kept here as the baseline for comparison.
+def legacy_find_valid_move(
+        prev_state: chess.Board,
+        new_state: List[Optional[chess.Piece]]) -> Tuple[Optional[chess.Move], bool]:
+    prev_piece_list = piece_list(prev_state)
+
+    # Firstly, if the pieces are detected to be exactly the same,
+    # we register that no move has been made.
+    if prev_piece_list == new_state:
+        return None, True
+
+    # Next, we check if there exists a legal move that can be made
+    # that will give us exactly what we see right now.
+    for move in prev_state.legal_moves:
+        prev_state.push(move)
+        match_found = piece_list(prev_state) == new_state
+        prev_state.pop()
+        if match_found:
+            return move, True
+
+    # Now, we check whether the occupancies are about the same.
+    # We consider "about the same" to be if the predicted piece colours
+    # in each square are the same.
+    prev_state_colour = colour_list(prev_piece_list)
+    new_state_colour = colour_list(new_state)
+
+    # If the colours are seen to be the same, we consider no move being made.
+    if prev_state_colour == new_state_colour:
+        return None, False
+
+    # Next, we check if there is a legal move that can achieve this form.
+    # We assume the first one we see is the only possible one,
+    # since each move will have a unique start and end point.
+    for move in prev_state.legal_moves:
+        prev_state.push(move)
+        match_found = colour_list(piece_list(prev_state)) == new_state_colour
+        prev_state.pop()
+        if match_found:
+            return move, False
+
+    # If the stricter checking did not work previously,
+    # we now focus only on piece presence rather than piece type.
+    true = full_occupancy(prev_state_colour)
+    pred = full_occupancy(new_state_colour)
+
+    # Firstly, if the predicted occupancy set is a subset of the true occupancy,
+    # we check whether either a capture happened or no move happened.
+    if pred <= true:
+        # Only consider captures here.
+        for move in prev_state.legal_moves:
+            if prev_state.piece_at(move.to_square) is not None:
+                prev_state.push(move)
+                possible_occ = full_occupancy(colour_list(piece_list(prev_state)))
+                prev_state.pop()
+                if pred <= possible_occ:
+                    return move, False
+        return None, False
+
+    # Next, we keep track of all the possible squares that can be moved to.
+    allowed_destinations = {m.to_square for m in prev_state.legal_moves}
+
+    new_pieces = pred - true
+    if len(new_pieces) == 1:
+        # If there is exactly one square which has a new piece that previously did not have one,
+        # we check all legal moves and make the move if the vacancies match or if only one is possible.
+        dest = new_pieces.pop()
+        if dest not in allowed_destinations:
+            raise MoveImpossibleException(f'No piece can move to {sqn(dest)}')
+        possible_origins = {m.from_square for m in prev_state.legal_moves if m.to_square == dest}
+        if len(possible_origins) == 1:
+            return chess.Move(possible_origins.pop(), dest), False
+        vacant_squares = possible_origins - pred
+        if len(vacant_squares) == 1:
+            return chess.Move(vacant_squares.pop(), dest), False
+        else:
+            raise MoveImpossibleException(
+                f'Which piece out of {sqn(vacant_squares)} moved to {sqn(dest)}?')
+    else:
+        # Otherwise, if there are multiple differences, we check to see whether the
+        # characteristics of the possible positions match.
+        for move in prev_state.legal_moves:
+            prev_state.push(move)
+            possible_occ = full_occupancy(colour_list(piece_list(prev_state)))
+            prev_state.pop()
+            if pred <= possible_occ:
+                return move, False
+
+    # If the above could not resolve a move, then multiple pieces must have been shuffled and disoriented.
+    raise MoveImpossibleException('No legal move found for this transition')
+
+def random_positions(rng: random.Random, games: int, max_plies: int) -> List[chess.Board]:
+    positions = []
+    for _ in range(games):
+        board = chess.Board()
+        for _ in range(rng.randrange(1, max_plies)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+            positions.append(board.copy(stack=False))
+    return positions
+
+# Simulated detections of the board after a random legal move (or no move),
+# degraded in the ways the model tends to get wrong.
+def simulated_readings(rng: random.Random, board: chess.Board) -> List[Reading]:
+    moves = list(board.legal_moves)
+    after = board.copy(stack=False)
+    if moves:
+        after.push(rng.choice(moves))
+    exact = piece_list(after)
+
+    # Right colours, wrong piece types.
+    colour_only = [None if p is None else chess.Piece(rng.randint(1, 6), p.color) for p in exact]
+
+    # A piece occluded (missing) from the reading.
+    occluded = list(exact)
+    occupied = [sq for sq in range(64) if occluded[sq] is not None]
+    occluded[rng.choice(occupied)] = None
+
+    # A spurious piece detected on an empty square.
+    spurious = list(exact)
+    empty = [sq for sq in range(64) if spurious[sq] is None]
+    spurious[rng.choice(empty)] = chess.Piece(chess.PAWN, rng.choice(chess.COLORS))
+
+    return [piece_list(board), exact, colour_only, occluded, spurious]
+
+def outcome(matcher: Callable, board: chess.Board, reading: Reading) -> Tuple:
+    try:
+        return ('ok',) + matcher(board, reading)
+    except MoveImpossibleException as err:
+        return ('impossible',) + err.args
+
+def time_matcher(matcher: Callable, cases: List[Tuple[chess.Board, Reading]], repeats: int) -> float:
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for board, reading in cases:
+            try:
+                matcher(board, reading)
+            except MoveImpossibleException:
+                pass
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bitboard move matcher against the original.')
+    parser.add_argument('--games', type=int, default=50)
+    parser.add_argument('--max-plies', type=int, default=120)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=19937)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    positions = random_positions(rng, args.games, args.max_plies)
+    cases = [(board, reading) for board in positions for reading in simulated_readings(rng, board)]
+
+    mismatches = 0
+    for board, reading in cases:
+        if outcome(legacy_find_valid_move, board, reading) != outcome(find_valid_move, board, reading):
+            mismatches += 1
+
+    legacy_time = time_matcher(legacy_find_valid_move, cases, args.repeats)
+
+    # Index construction is timed separately, but since the cache holds fewer positions
+    # than are sampled here, the matcher timings below also include rebuilding each index once.
+    MOVE_INDEX_CACHE.clear()
+    start = time.perf_counter()
+    for board in positions:
+        move_index(board)
+    index_time = time.perf_counter() - start
+    bitboard_time = time_matcher(find_valid_move, cases, args.repeats)
+
+    print(json.dumps({
+        'positions': len(positions),
+        'readings': len(cases),
+        'mismatches': mismatches,
+        'legacy_us_per_reading': legacy_time / len(cases) * 1e6,
+        'index_build_us_per_position': index_time / len(positions) * 1e6,
+        'bitboard_us_per_reading': bitboard_time / len(cases) * 1e6,
+        'speedup': legacy_time / bitboard_time,
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# Offline replay benchmark of the whole recognition pipeline, with no HTTP involved.
+# Run from the repository root with e.g.
+# `python -m benchmarks.replay fide2023-game18 fide2023-game18.pgn --model models/trained_yolo11m-v0-1-0.pt`.
+#
+# The frames of a folder (laid out as for `demo/image_server.py`) are replayed in order,
+# starting from the initial position, and each frame is timed through the stages of the server:
+# decoding the image, model inference, drawing the annotated image, assigning detections to squares,
+# and matching the reading against the legal moves of the game so far.
+# The moves registered are compared against the reference PGN, and the report is printed as JSON
+# (and optionally written to a file) so that runs can be compared across commits and backends.
+
+import argparse
+import chess
+import chess.pgn
+import cv2
+import json
+import numpy as np
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from server.detector import load_detector
+from server.geometry import BoardGeometry, fit_homography
+from server.read import SquareState, corner_points, detections_to_board, detections_to_squares, predict_detections
+from server.state import find_valid_move
+from server.transcribe import frame_paths
+from server.types import ImageConversionException, MoveIllegalException, MoveImpossibleException
+
+STAGES = ['decode', 'inference', 'plot', 'squares', 'match', 'total']
+
+def reference_moves(pgn_path: str) -> List[chess.Move]:
+    with open(pgn_path) as f:
+        game = chess.pgn.read_game(f)
+    if game is None:
+        raise ValueError(f'No game found in {pgn_path}')
+    return list(game.mainline_moves())
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    ms = np.array(samples) * 1000
+    return {
+        'mean': float(ms.mean()),
+        'p50': float(np.percentile(ms, 50)),
+        'p95': float(np.percentile(ms, 95)),
+        'p99': float(np.percentile(ms, 99)),
+        'max': float(ms.max()),
+    }
+
+# Compares the moves registered during the replay against the reference game, ply by ply.
+def move_accuracy(detected: List[chess.Move], expected: List[chess.Move]) -> Dict[str, Any]:
+    correct = sum(d == e for d, e in zip(detected, expected))
+    prefix = 0
+    while prefix < min(len(detected), len(expected)) and detected[prefix] == expected[prefix]:
+        prefix += 1
+    return {
+        'expected_moves': len(expected),
+        'detected_moves': len(detected),
+        'correct_moves': correct,
+        'correct_prefix': prefix,
+        'accuracy': correct / len(expected) if expected else 0.0,
+        'game_matches': detected == expected,
+    }
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# The peak resident set size of this process so far, in megabytes.
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def replay(args: argparse.Namespace) -> Dict[str, Any]:
+    paths = frame_paths(args.frames)[:args.limit]
+    expected = reference_moves(args.pgn)
+
+    load_start = time.perf_counter()
+    model = load_detector(args.model, threads=args.threads, warmup=args.warmup)
+    load_time = time.perf_counter() - load_start
+
+    board = chess.Board()
+    geometry = BoardGeometry() if args.cache_geometry else None
+    squares = SquareState() if args.track_squares else None
+    timings: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    errors = {'image-decode': 0, 'image-conversion': 0, 'move-illegal': 0, 'move-impossible': 0}
+    inexact_moves = 0
+
+    replay_start = time.perf_counter()
+    for path in paths:
+        frame_start = time.perf_counter()
+        image = cv2.imread(path)
+        decoded = time.perf_counter()
+        timings['decode'].append(decoded - frame_start)
+        if image is None:
+            errors['image-decode'] += 1
+            continue
+
+        xywhn, confs, labels, plot = predict_detections(model, image, args.imgsz, args.conf)
+        inferred = time.perf_counter()
+        timings['inference'].append(inferred - decoded)
+
+        if args.plot:
+            plot()
+        plotted = time.perf_counter()
+        timings['plot'].append(plotted - inferred)
+
+        try:
+            corners = corner_points(xywhn, labels)
+            homography = geometry.homography(corners) if geometry is not None else fit_homography(corners)
+            if squares is not None:
+                reading = squares.update(detections_to_squares(xywhn, confs, labels, homography))
+            else:
+                reading = detections_to_board(xywhn, confs, labels, homography)
+        except ImageConversionException:
+            errors['image-conversion'] += 1
+            continue
+        finally:
+            assigned = time.perf_counter()
+            timings['squares'].append(assigned - plotted)
+
+        try:
+            move, exact = find_valid_move(board, reading)
+        except MoveIllegalException:
+            errors['move-illegal'] += 1
+            move = None
+        except MoveImpossibleException:
+            errors['move-impossible'] += 1
+            move = None
+        matched = time.perf_counter()
+        timings['match'].append(matched - assigned)
+        timings['total'].append(matched - frame_start)
+
+        if move is not None:
+            board.push(move)
+            inexact_moves += not exact
+    replay_time = time.perf_counter() - replay_start
+
+    return {
+        'revision': git_revision(),
+        'model': args.model,
+        'backend': type(model).__name__,
+        'threads': args.threads,
+        'imgsz': args.imgsz,
+        'conf': args.conf,
+        'track_squares': args.track_squares,
+        'frames': len(paths),
+        'model_load_s': load_time,
+        'replay_s': replay_time,
+        'fps': len(paths) / replay_time if replay_time > 0 else 0.0,
+        'latency_ms': {stage: latency_summary(samples) for stage, samples in timings.items()},
+        'moves': dict(move_accuracy(board.move_stack, expected), inexact_moves=inexact_moves),
+        'final_fen': board.fen(),
+        'errors': errors,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a folder of frames through the recognition pipeline.')
+    parser.add_argument('frames', help='folder of frames, named in playing order (e.g. 0001.png, 0002.png, ...)')
+    parser.add_argument('pgn', help='PGN of the game shown in the frames')
+    parser.add_argument('--model', default=os.environ.get('MEMOCHESS_MODEL', 'models/trained_yolo11m-v0-1-0.pt'),
+                        help='model weights, exported .onnx file or OpenVINO model directory')
+    parser.add_argument('--threads', type=int, default=None, help='inference threads')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--conf', type=float, default=0.25, help='detection confidence threshold')
+    parser.add_argument('--track-squares', action='store_true',
+                        help='carry square contents between frames, as each server session does')
+    parser.add_argument('--no-warmup', dest='warmup', action='store_false',
+                        help='skip warming up the model before timing (so the first frames include it)')
+    parser.add_argument('--limit', type=int, default=None, help='only replay the first LIMIT frames')
+    parser.add_argument('--no-plot', dest='plot', action='store_false',
+                        help='skip drawing the annotated image (as when nobody is watching it)')
+    parser.add_argument('--no-geometry-cache', dest='cache_geometry', action='store_false',
+                        help='fit the board homography from scratch on every frame')
+    parser.add_argument('--output', default=None, help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    report = replay(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
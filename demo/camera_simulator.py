@@ -0,0 +1,183 @@
+# A simulated fleet of IP webcams for load testing, in place of `image_server.py`.
+# Run from the repository root, passing the paths of the sample image folders, for example:
+#
+#   python -m demo.camera_simulator fide2023-game18 fide2024-game14 --boards 16 --seconds-per-frame 4 \
+#       --jitter 0.05 --drop-rate 0.01 --occlusion-rate 0.05
+#
+# Every frame of every folder is decoded and re-encoded once at startup and then served from memory.
+# Each simulated board plays back one of the folders (assigned in turn) on its own clock,
+# advancing one frame every `--seconds-per-frame` however often it is polled,
+# with the boards' start times staggered so that their moves do not all land at once.
+#
+# Board `n` is served as if it were the webcam `<host>:<port>/boards/<n>`, so that the main server reads it
+# from `/boards/<n>/video`: an MJPEG stream like the IP Webcam app's (or a single image per request with `--still`).
+# `/video` serves board 0, for use in place of `image_server.py`.
+#
+# Faults are injected per frame: a fixed `--latency` plus up to `--jitter` seconds of random delay,
+# frames dropped with probability `--drop-rate` (skipped in the stream, or answered with a 503 when `--still`),
+# and with probability `--occlusion-rate`, a frame with a "hand" covering part of the board.
+
+import argparse
+from flask import Flask, Response, jsonify
+from flask_cors import CORS
+
+import cv2
+import numpy as np
+import random
+import time
+from typing import List, Optional
+
+from server.stream import MJPEG_MIMETYPE, mjpeg_part
+from server.transcribe import frame_paths
+
+app = Flask(__name__)
+CORS(app)
+
+def encode(image: np.ndarray, encoding: str, quality: int) -> bytes:
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if encoding == 'jpg' else []
+    _, blob = cv2.imencode(f'.{encoding}', image, params)
+    return blob.tobytes()
+
+# Covers a patch of the board with a flat skin-coloured blob, roughly where a player's hand and arm would be.
+def occlude(image: np.ndarray, rng: random.Random) -> np.ndarray:
+    height, width = image.shape[:2]
+    occluded = image.copy()
+    centre = (int(width * rng.uniform(0.3, 0.7)), int(height * rng.uniform(0.3, 0.7)))
+    axes = (int(width * 0.12), int(height * 0.18))
+    cv2.ellipse(occluded, centre, axes, rng.uniform(0, 180), 0, 360, (120, 160, 220), -1)
+    arm = (centre[0] - axes[0] // 2, centre[1]), (centre[0] + axes[0] // 2, height)
+    cv2.rectangle(occluded, *arm, (110, 150, 210), -1)
+    return occluded
+
+# The frames of one folder, encoded once, along with an occluded variant of each if needed.
+class Recording:
+    def __init__(self, folder: str, encoding: str, quality: int, occlusions: bool):
+        rng = random.Random(folder)
+        self.frames: List[bytes] = []
+        self.occluded: List[bytes] = []
+        for path in frame_paths(folder):
+            image = cv2.imread(path)
+            if image is None:
+                continue
+            self.frames.append(encode(image, encoding, quality))
+            if occlusions:
+                self.occluded.append(encode(occlude(image, rng), encoding, quality))
+        if not self.frames:
+            raise ValueError(f'No images found in {folder}')
+
+    def size(self) -> int:
+        return sum(map(len, self.frames)) + sum(map(len, self.occluded))
+
+class SimulatedBoard:
+    def __init__(self, recording: Recording, start: float, seconds_per_frame: float, loop: bool):
+        self.recording = recording
+        self.start = start
+        self.seconds_per_frame = seconds_per_frame
+        self.loop = loop
+
+    def frame_index(self, now: float) -> int:
+        index = max(0, int((now - self.start) / self.seconds_per_frame))
+        count = len(self.recording.frames)
+        return index % count if self.loop else min(index, count - 1)
+
+    # The encoded frame to serve now, after the injected delay, or `None` if this frame is dropped.
+    def next_frame(self, rng: random.Random) -> Optional[bytes]:
+        delay = ARGS.latency + rng.uniform(0, ARGS.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if rng.random() < ARGS.drop_rate:
+            return None
+        index = self.frame_index(time.monotonic())
+        if self.recording.occluded and rng.random() < ARGS.occlusion_rate:
+            return self.recording.occluded[index]
+        return self.recording.frames[index]
+
+ARGS: Optional[argparse.Namespace] = None
+BOARDS: List[SimulatedBoard] = []
+MIMETYPE = 'image/jpeg'
+
+@app.route('/')
+def root():
+    return jsonify({'image-server': True, 'boards': len(BOARDS)})
+
+@app.route('/boards')
+def boards():
+    now = time.monotonic()
+    return jsonify([
+        {'board': n, 'frame': board.frame_index(now), 'frames': len(board.recording.frames)}
+        for n, board in enumerate(BOARDS)
+    ])
+
+@app.route('/video')
+def video():
+    return board_video(0)
+
+@app.route('/boards/<int:n>/video')
+def board_video(n: int):
+    if not 0 <= n < len(BOARDS):
+        return jsonify({'error': f'No board {n}'}), 404
+    board = BOARDS[n]
+    rng = random.Random()
+
+    if ARGS.still:
+        frame = board.next_frame(rng)
+        if frame is None:
+            return 'Frame dropped', 503
+        return Response(frame, mimetype=MIMETYPE, headers={'Cache-Control': 'no-store'})
+
+    def stream():
+        interval = 1.0 / ARGS.fps
+        while True:
+            started = time.monotonic()
+            frame = board.next_frame(rng)
+            if frame is not None:
+                yield mjpeg_part(frame)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    return Response(stream(), mimetype=MJPEG_MIMETYPE, headers={'Cache-Control': 'no-store'})
+
+def main():
+    global ARGS, MIMETYPE
+    parser = argparse.ArgumentParser(description='Serve recorded games as many simulated IP webcams.')
+    parser.add_argument('folders', nargs='+', help='folders of frames, named in playing order')
+    parser.add_argument('--boards', type=int, default=None, help='simulated boards (default: one per folder)')
+    parser.add_argument('--seconds-per-frame', type=float, default=5.0, help='how long each frame is shown')
+    parser.add_argument('--stagger', type=float, default=None,
+                        help='seconds between the start times of consecutive boards '
+                             '(default: spread evenly over one frame)')
+    parser.add_argument('--no-loop', dest='loop', action='store_false',
+                        help='hold the last frame at the end of a game instead of starting again')
+    parser.add_argument('--encoding', choices=['jpg', 'png'], default='jpg', help='how frames are served')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality')
+    parser.add_argument('--still', action='store_true',
+                        help='serve one image per request at /video instead of an MJPEG stream')
+    parser.add_argument('--fps', type=float, default=10.0, help='frame rate of the MJPEG streams')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of delay added to every frame')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds of random extra delay')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability that a frame is dropped')
+    parser.add_argument('--occlusion-rate', type=float, default=0.0,
+                        help='probability that a frame shows a hand over the board')
+    parser.add_argument('--port', type=int, default=6173)
+    ARGS = parser.parse_args()
+
+    if ARGS.still and ARGS.encoding == 'png':
+        MIMETYPE = 'image/png'
+    elif not ARGS.still and ARGS.encoding != 'jpg':
+        parser.error('MJPEG streams need --encoding jpg')
+
+    occlusions = ARGS.occlusion_rate > 0
+    recordings = [Recording(folder, ARGS.encoding, ARGS.quality, occlusions) for folder in ARGS.folders]
+    megabytes = sum(recording.size() for recording in recordings) / (1024 * 1024)
+    print(f'Loaded {sum(len(r.frames) for r in recordings)} frames ({megabytes:.1f} MB)', flush=True)
+
+    board_count = ARGS.boards or len(recordings)
+    stagger = ARGS.stagger if ARGS.stagger is not None else ARGS.seconds_per_frame / board_count
+    now = time.monotonic()
+    BOARDS.extend(
+        SimulatedBoard(recordings[n % len(recordings)], now + n * stagger, ARGS.seconds_per_frame, ARGS.loop)
+        for n in range(board_count))
+
+    app.run(port=ARGS.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,97 @@
 import chess
 import numpy as np
-from typing import List, Optional, Tuple
-from ultralytics import YOLO
+from typing import Callable, List, Optional, Tuple
 
-from server.read import yolo_image_to_board
-from server.state import find_valid_move
+from server.detector import Detector
+from server.gate import MotionGate
+from server.read import BoardReader, yolo_image_to_board
+from server.state import PositionHistory, find_move_sequence, find_valid_move
 from server.types import *
 
-def continuing_game(
+# Boards are read through the caller's `BoardReader` when given,
+# so that geometry learned from earlier frames of the same camera is reused.
+# Along with the board, this returns a callable that draws the model's predictions onto the frame.
+def read_board(
+        model: Detector,
+        image: np.ndarray,
+        reader: Optional[BoardReader] = None) -> Tuple[List[Optional[chess.Piece]], Callable[[], np.ndarray]]:
+    if reader is None:
+        return yolo_image_to_board(model, image)
+    return reader.read(model, image)
+
+def earlier_position(prev_state: chess.Board, ply: int) -> EarlierPositionException:
+    plies_back = len(prev_state.move_stack) - ply
+    return EarlierPositionException(f'The live board matches the position from {plies_back} half-move(s) ago.', ply)
+
+# Matches a reading against the game, as `find_valid_move` does, returning the moves played since.
+# If a `history` of the game is given and no single move explains the reading exactly,
+# but it is exactly one of the game's earlier positions, an `EarlierPositionException` is raised instead
+# (so that e.g. a knight moved out and back again is offered as a rollback rather than registered as two moves).
+# Otherwise, with `max_plies` above one, the reading is also matched against sequences of up to that many moves,
+# in case frames were missed in between.
+def match_reading(
+        prev_state: chess.Board,
+        new_state: List[Optional[chess.Piece]],
+        history: Optional[PositionHistory] = None,
+        max_plies: int = 1) -> Tuple[List[chess.Move], bool]:
+    try:
+        move, exact = find_valid_move(prev_state, new_state)
+    except (MoveIllegalException, MoveImpossibleException) as err:
+        error = err
+    else:
+        if exact:
+            return ([] if move is None else [move]), exact
+        error = None
+
+    if history is not None and (ply := history.earlier_ply(new_state)) is not None:
+        raise earlier_position(prev_state, ply)
+    if max_plies > 1:
+        try:
+            moves, sequence_exact = find_move_sequence(prev_state, new_state, max_plies)
+            # An inexact single move is only overridden by a sequence that explains the reading exactly.
+            if error is not None or sequence_exact:
+                return moves, sequence_exact
+        except MoveImpossibleException:
+            pass
+    if error is not None:
+        raise error
+    return ([] if move is None else [move]), exact
+
+# Reads a new frame of a game in progress and matches it against the game.
+# The frame is first passed through the motion gate.
+# If the scene is unchanged since the last inference, the cached reading is matched instead,
+# and if the scene is still in motion, no move is registered until it settles.
+# Once the reader has located the board, the gate only watches the board's region of the frame.
+# The gate decision is returned alongside so that callers can tell a skipped frame apart from no move.
+def gated_continuing_game(
         prev_state: chess.Board,
-        model: YOLO,
-        image: np.ndarray) -> Tuple[Optional[chess.Move], bool]:
-    new_state, pred_image = yolo_image_to_board(model, image)
-    return find_valid_move(prev_state, new_state), pred_image
+        model: Detector,
+        image: np.ndarray,
+        gate: MotionGate,
+        reader: Optional[BoardReader] = None,
+        history: Optional[PositionHistory] = None,
+        max_plies: int = 1) -> Tuple[Tuple[List[chess.Move], bool], Optional[Callable[[], np.ndarray]], GateDecision]:
+    decision = gate.observe(image)
+    if decision == GateDecision.InMotion:
+        return ([], True), None, decision
+    if decision == GateDecision.Unchanged:
+        return match_reading(prev_state, gate.reading, history, max_plies), None, decision
+    new_state, pred_plot = read_board(model, image, reader)
+    gate.record(new_state, None if reader is None else reader.geometry.region())
+    return match_reading(prev_state, new_state, history, max_plies), pred_plot, decision
 
 def resuming_game(
         prev_state: chess.Board,
-        model: YOLO,
-        image: np.ndarray) -> GameResumeOutcome:
-    new_state, pred_image = yolo_image_to_board(model, image)
-    move, exact = find_valid_move(prev_state, new_state)
-    if move is None:
+        model: Detector,
+        image: np.ndarray,
+        reader: Optional[BoardReader] = None,
+        history: Optional[PositionHistory] = None) -> GameResumeOutcome:
+    new_state, pred_plot = read_board(model, image, reader)
+    moves, exact = match_reading(prev_state, new_state, history)
+    if not moves:
         if exact:
-            return GameResumeOutcome.ExactMatch, pred_image
+            return GameResumeOutcome.ExactMatch, pred_plot
         else:
-            return GameResumeOutcome.InexactMatch, pred_image
+            return GameResumeOutcome.InexactMatch, pred_plot
     else:
-        return GameResumeOutcome.PossibleMoveMade, pred_image
+        return GameResumeOutcome.PossibleMoveMade, pred_plot
@@ -0,0 +1,117 @@
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Future
+import numpy as np
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from server.detector import Detections, Detector
+from server.types import InferenceBusyException
+
+PendingFrame = namedtuple('PendingFrame', ['image', 'options', 'future', 'enqueued'])
+
+# Running statistics on the batches formed by the scheduler.
+class BatchStatistics:
+    def __init__(self, window: int = 1024):
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.recent_waits = deque(maxlen=window)
+        self.total_wait = 0.0
+        self.frames = 0
+
+    def record(self, batch: List[PendingFrame], started: float):
+        waits = [started - p.enqueued for p in batch]
+        with self.lock:
+            self.batch_sizes[len(batch)] += 1
+            self.recent_waits.extend(waits)
+            self.total_wait += sum(waits)
+            self.frames += len(batch)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            waits = np.array(self.recent_waits) * 1000
+            return {
+                'batches': batches,
+                'frames': self.frames,
+                'mean_batch_size': self.frames / batches if batches else 0.0,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'queue_wait_ms': {
+                    'mean': self.total_wait * 1000 / self.frames if self.frames else 0.0,
+                    'p50': float(np.percentile(waits, 50)) if len(waits) else 0.0,
+                    'p95': float(np.percentile(waits, 95)) if len(waits) else 0.0,
+                    'max': float(waits.max()) if len(waits) else 0.0,
+                },
+            }
+
+# Collects frames submitted from concurrent requests and runs them through the detector together.
+# A batch is closed once `max_batch_size` frames are queued,
+# or once the oldest frame in it has waited `max_wait_ms` milliseconds,
+# and every frame then receives its own result through a future.
+# The scheduler is itself a `Detector`, so it can be passed anywhere a detector is expected.
+# At most `max_pending` frames may wait for inference; beyond that, frames are refused with
+# `InferenceBusyException` so that an overloaded server sheds load instead of letting latency grow without bound.
+# Offline callers, which bound their own work in flight and would rather wait than lose frames, pass `max_pending=None`.
+class InferenceScheduler(Detector):
+    def __init__(
+            self,
+            detector: Detector,
+            max_batch_size: int = 8,
+            max_wait_ms: float = 10.0,
+            max_pending: Optional[int] = 32):
+        self.detector = detector
+        self.names = detector.names
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_pending = max_pending
+        self.queue = queue.Queue()
+        self.stats = BatchStatistics()
+        self.thread = threading.Thread(target=self.run, name='inference-scheduler', daemon=True)
+        self.thread.start()
+
+    def submit(self, image: np.ndarray, **options) -> Future:
+        if self.max_pending is not None and self.queue.qsize() >= self.max_pending:
+            raise InferenceBusyException(f'{self.max_pending} frames are already waiting for inference')
+        future = Future()
+        self.queue.put(PendingFrame(image, options, future, time.monotonic()))
+        return future
+
+    def detect(self, images: List[np.ndarray], imgsz: int = 640, conf: float = 0.25) -> List[Detections]:
+        futures = [self.submit(image, imgsz=imgsz, conf=conf) for image in images]
+        return [future.result() for future in futures]
+
+    def statistics(self) -> Dict[str, Any]:
+        return self.stats.snapshot()
+
+    def collect(self) -> List[PendingFrame]:
+        batch = [self.queue.get()]
+        deadline = batch[0].enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            started = time.monotonic()
+            self.stats.record(batch, started)
+
+            # Frames requested with different detection arguments cannot share a forward pass.
+            groups: Dict[tuple, List[PendingFrame]] = {}
+            for pending in batch:
+                groups.setdefault(tuple(sorted(pending.options.items())), []).append(pending)
+
+            for group in groups.values():
+                try:
+                    results = self.detector.detect([p.image for p in group], **group[0].options)
+                except Exception as err:
+                    for pending in group:
+                        pending.future.set_exception(err)
+                    continue
+                for pending, result in zip(group, results):
+                    pending.future.set_result(result)
@@ -0,0 +1,195 @@
+import cv2
+from collections import deque, namedtuple
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+from typing import Dict, Optional
+
+from server.metrics import CAPTURE_MISSES, CAPTURE_RECONNECTS, count
+
+TimestampedFrame = namedtuple('TimestampedFrame', ['timestamp', 'frame'])
+
+# One pooled HTTP session is shared by all readers that fall back to fetching still images,
+# so repeated fetches reuse the same TCP connections instead of renegotiating each time.
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+def decode_image(content: bytes) -> Optional[np.ndarray]:
+    # `cv2.imdecode` returns the image in BGR order, matching what `cv2.VideoCapture` gives.
+    return cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+# A long-lived reader attached to a single webcam URL.
+# A background thread continuously decodes frames into a small ring buffer,
+# reconnecting when the stream drops and stopping itself once nobody has asked for a frame in a while.
+# All camera I/O happens on that thread, with `connect_timeout` and `read_timeout` (in seconds) applied,
+# so a stalled camera can only ever hold up its own reader, never a request.
+class FrameReader:
+    def __init__(
+            self,
+            webcam_ip: str,
+            buffer_size: int = 4,
+            idle_timeout: float = 30.0,
+            reconnect_delay: float = 1.0,
+            poll_interval: float = 0.5,
+            connect_timeout: float = 3.0,
+            read_timeout: float = 5.0):
+        self.webcam_ip = webcam_ip
+        self.url = f'http://{webcam_ip}/video'
+        self.idle_timeout = idle_timeout
+        self.reconnect_delay = reconnect_delay
+        self.poll_interval = poll_interval
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Whether the last attempt to connect to the camera failed, and no frame has arrived since.
+        self.failing = False
+        # Whether the camera serves still images rather than a video stream.
+        self.still = False
+
+        self.frames = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.last_access = time.monotonic()
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.run, name=f'capture-{webcam_ip}', daemon=True)
+        self.thread.start()
+
+    def is_alive(self) -> bool:
+        return not self.stopped.is_set()
+
+    def is_idle(self) -> bool:
+        return time.monotonic() - self.last_access > self.idle_timeout
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def should_stop(self) -> bool:
+        if self.is_idle():
+            self.stopped.set()
+        return self.stopped.is_set()
+
+    def publish(self, frame: np.ndarray):
+        with self.condition:
+            self.frames.append(TimestampedFrame(time.monotonic(), frame))
+            self.failing = False
+            self.condition.notify_all()
+
+    def fail(self):
+        with self.condition:
+            self.failing = True
+            self.condition.notify_all()
+
+    # Returns the newest frame, waiting up to `wait` seconds if none has arrived yet.
+    # There is no waiting once the camera is known to be unreachable, so requests for it fail fast.
+    # Frames older than `max_age` seconds are considered stale (the camera has stalled).
+    def latest(self, wait: float = 0.0, max_age: Optional[float] = None) -> Optional[TimestampedFrame]:
+        self.last_access = time.monotonic()
+        with self.condition:
+            if not self.frames and wait > 0:
+                self.condition.wait_for(
+                    lambda: self.frames or self.failing or self.stopped.is_set(), timeout=wait)
+            if not self.frames:
+                return None
+            newest = self.frames[-1]
+        if max_age is not None and time.monotonic() - newest.timestamp > max_age:
+            return None
+        return newest
+
+    def run(self):
+        while not self.should_stop():
+            if not self.still:
+                frames = self.stream()
+                if frames > 1:
+                    self.dropped()
+                    continue
+                # FFmpeg reads a still image as a stream of one frame, so reconnecting straight away
+                # would fetch the image as fast as the server can send it. It is polled instead.
+                if frames == 1:
+                    self.still = True
+                    self.stopped.wait(self.poll_interval)
+            # This branch is here to accommodate for HTTP servers
+            # that proxy a live streaming image feed,
+            # in case this app is to be tested without an IP camera.
+            if self.poll():
+                self.dropped()
+                continue
+            self.still = False
+            self.fail()
+            self.stopped.wait(self.reconnect_delay)
+
+    # Called when frames stop arriving from a connection that had been delivering them.
+    def dropped(self):
+        if not self.stopped.is_set():
+            count(CAPTURE_RECONNECTS, webcam=self.webcam_ip)
+
+    # Reads from a continuous video stream until it drops.
+    # Returns how many frames were read.
+    def stream(self) -> int:
+        cap = cv2.VideoCapture(self.url, cv2.CAP_FFMPEG, [
+            cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(self.connect_timeout * 1000),
+            cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(self.read_timeout * 1000),
+        ])
+        if not cap.isOpened():
+            return 0
+        received = 0
+        try:
+            while not self.should_stop():
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                self.publish(frame)
+                received += 1
+        finally:
+            cap.release()
+        return received
+
+    # Repeatedly fetches still images over the pooled HTTP session until a fetch fails.
+    # Returns whether any frame was fetched at all.
+    def poll(self) -> bool:
+        received = False
+        while not self.should_stop():
+            try:
+                response = HTTP_SESSION.get(self.url, timeout=(self.connect_timeout, self.read_timeout))
+            except requests.RequestException:
+                break
+            if not response.ok:
+                break
+            frame = decode_image(response.content)
+            if frame is None:
+                break
+            self.publish(frame)
+            received = True
+            self.stopped.wait(self.poll_interval)
+        return received
+
+# Keeps one `FrameReader` per webcam, starting them on demand
+# and replacing readers that have shut down after sitting idle.
+class CaptureRegistry:
+    def __init__(self, **reader_options):
+        self.reader_options = reader_options
+        self.readers: Dict[str, FrameReader] = {}
+        self.lock = threading.Lock()
+
+    def reader(self, webcam_ip: str) -> FrameReader:
+        with self.lock:
+            # Drop any readers that have stopped themselves since the last lookup.
+            for ip in [ip for ip, r in self.readers.items() if not r.is_alive()]:
+                del self.readers[ip]
+            reader = self.readers.get(webcam_ip)
+            if reader is None:
+                reader = FrameReader(webcam_ip, **self.reader_options)
+                self.readers[webcam_ip] = reader
+            return reader
+
+    def latest_frame(
+            self,
+            webcam_ip: str,
+            wait: float = 5.0,
+            max_age: Optional[float] = 5.0) -> Optional[TimestampedFrame]:
+        captured = self.reader(webcam_ip).latest(wait=wait, max_age=max_age)
+        if captured is None:
+            count(CAPTURE_MISSES, webcam=webcam_ip)
+        return captured
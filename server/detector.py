@@ -0,0 +1,217 @@
+from abc import ABC, abstractmethod
+import ast
+from collections import namedtuple
+import cv2
+from functools import partial
+import numpy as np
+import os
+from typing import Dict, List, Optional, Tuple
+import yaml
+
+# The detections from a single image, as plain arrays:
+# normalised (x, y, w, h) boxes, confidences and class ids, the class names,
+# and a callable that draws the detections onto the image.
+Detections = namedtuple('Detections', ['xywhn', 'conf', 'cls', 'names', 'plot'])
+
+# The interface the board reader depends on, instead of an Ultralytics `YOLO` object directly.
+# Implementations take a batch of BGR images and return one `Detections` per image.
+class Detector(ABC):
+    names: Dict[int, str] = {}
+
+    @abstractmethod
+    def detect(self, images: List[np.ndarray], imgsz: int = 640, conf: float = 0.25) -> List[Detections]:
+        pass
+
+    # The first inferences on a freshly loaded model are much slower than the rest,
+    # so this is run once at startup rather than on the first live frame.
+    def warmup(self, imgsz: int = 640, runs: int = 2):
+        blank = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+        for _ in range(runs):
+            self.detect([blank], imgsz=imgsz)
+
+# Eager PyTorch inference through Ultralytics, on the `.pt` weights.
+class TorchDetector(Detector):
+    def __init__(self, weights: str, threads: Optional[int] = None):
+        import torch
+        from ultralytics import YOLO
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.model = YOLO(weights)
+        self.names = self.model.names
+
+    def detect(self, images: List[np.ndarray], imgsz: int = 640, conf: float = 0.25) -> List[Detections]:
+        results = self.model.predict(images, imgsz=imgsz, conf=conf, verbose=False)
+        return [
+            Detections(
+                xywhn=result.boxes.xywhn.cpu().numpy().astype(np.float64),
+                conf=result.boxes.conf.cpu().numpy(),
+                cls=result.boxes.cls.cpu().numpy().astype(int),
+                names=result.names,
+                plot=result.plot)
+            for result in results
+        ]
+
+# Resizes an image to fit in a square of side `imgsz`, padding the rest (as Ultralytics does).
+# Returns the padded image, the scale applied, and the (x, y) padding on the left and top.
+def letterbox(image: np.ndarray, imgsz: int) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    height, width = image.shape[:2]
+    scale = min(imgsz / height, imgsz / width)
+    resized_width, resized_height = round(width * scale), round(height * scale)
+    resized = cv2.resize(image, (resized_width, resized_height), interpolation=cv2.INTER_LINEAR)
+    left, top = (imgsz - resized_width) // 2, (imgsz - resized_height) // 2
+    padded = cv2.copyMakeBorder(
+        resized, top, imgsz - resized_height - top, left, imgsz - resized_width - left,
+        cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return padded, scale, (left, top)
+
+# Converts a batch of BGR images into the NCHW float input of an exported YOLO model.
+def preprocess(images: List[np.ndarray], imgsz: int) -> Tuple[np.ndarray, List[Tuple[float, Tuple[int, int]]]]:
+    padded, transforms = [], []
+    for image in images:
+        boxed, scale, pad = letterbox(image, imgsz)
+        padded.append(boxed)
+        transforms.append((scale, pad))
+    batch = np.stack(padded)[..., ::-1].transpose(0, 3, 1, 2)
+    return np.ascontiguousarray(batch, dtype=np.float32) / 255, transforms
+
+# Decodes the raw (4 + classes, anchors) output of an exported YOLO model for one image,
+# applying the confidence threshold and per-class non-maximum suppression,
+# and undoing the letterbox so boxes are normalised to the original image.
+def postprocess(
+        output: np.ndarray,
+        image_shape: Tuple[int, int],
+        transform: Tuple[float, Tuple[int, int]],
+        conf: float,
+        iou: float = 0.7) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    predictions = output.T
+    scores = predictions[:, 4:]
+    cls = scores.argmax(axis=1)
+    confs = scores[np.arange(len(cls)), cls]
+    keep = confs >= conf
+    xywh, cls, confs = predictions[keep, :4], cls[keep], confs[keep]
+
+    if len(xywh) > 0:
+        corner_boxes = np.column_stack([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, 2:]])
+        kept = cv2.dnn.NMSBoxesBatched(corner_boxes.tolist(), confs.tolist(), cls.tolist(), conf, iou)
+        kept = np.array(kept, dtype=int).reshape(-1)
+        xywh, cls, confs = xywh[kept], cls[kept], confs[kept]
+
+    scale, (left, top) = transform
+    height, width = image_shape
+    xywhn = xywh.astype(np.float64)
+    xywhn[:, 0] = (xywhn[:, 0] - left) / scale / width
+    xywhn[:, 1] = (xywhn[:, 1] - top) / scale / height
+    xywhn[:, 2] = xywhn[:, 2] / scale / width
+    xywhn[:, 3] = xywhn[:, 3] / scale / height
+    return xywhn, confs, cls
+
+def plot_detections(
+        image: np.ndarray,
+        xywhn: np.ndarray,
+        confs: np.ndarray,
+        cls: np.ndarray,
+        names: Dict[int, str]) -> np.ndarray:
+    plotted = image.copy()
+    height, width = image.shape[:2]
+    for (x, y, w, h), c, k in zip(xywhn, confs, cls):
+        p1 = (int((x - w / 2) * width), int((y - h / 2) * height))
+        p2 = (int((x + w / 2) * width), int((y + h / 2) * height))
+        cv2.rectangle(plotted, p1, p2, (0, 255, 0), 2)
+        cv2.putText(plotted, f'{names.get(int(k), k)} {c:.2f}', (p1[0], max(p1[1] - 4, 12)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1, cv2.LINE_AA)
+    return plotted
+
+# Shared by the exported-model backends, which only differ in how they run the raw forward pass.
+class ExportedDetector(Detector):
+    # The side of the square input the model was exported with, or `None` if it accepts any size.
+    fixed_imgsz: Optional[int] = None
+    # Whether the model accepts more than one image per forward pass.
+    dynamic_batch: bool = True
+
+    @abstractmethod
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        pass
+
+    def detect(self, images: List[np.ndarray], imgsz: int = 640, conf: float = 0.25) -> List[Detections]:
+        imgsz = self.fixed_imgsz or imgsz
+        batch, transforms = preprocess(images, imgsz)
+        if self.dynamic_batch:
+            outputs = self.forward(batch)
+        else:
+            outputs = np.concatenate([self.forward(batch[i:i + 1]) for i in range(len(images))])
+
+        detections = []
+        for image, output, transform in zip(images, outputs, transforms):
+            xywhn, confs, cls = postprocess(output, image.shape[:2], transform, conf)
+            detections.append(Detections(
+                xywhn=xywhn,
+                conf=confs,
+                cls=cls,
+                names=self.names,
+                plot=partial(plot_detections, image, xywhn, confs, cls, self.names)))
+        return detections
+
+# An exported `.onnx` model (FP32, or INT8 after static quantization) run with ONNX Runtime.
+class OnnxDetector(ExportedDetector):
+    def __init__(self, path: str, threads: Optional[int] = None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+        # Ultralytics stores the class names in the model metadata.
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata['names'])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+        self.fixed_imgsz = model_input.shape[2] if isinstance(model_input.shape[2], int) else None
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0]
+
+# An exported OpenVINO IR model (FP32, or INT8 after NNCF quantization).
+# `path` is either the `.xml` file or the directory Ultralytics exports it into.
+class OpenVinoDetector(ExportedDetector):
+    def __init__(self, path: str, threads: Optional[int] = None):
+        import openvino as ov
+        if os.path.isdir(path):
+            directory = path
+            path = next(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.xml'))
+        else:
+            directory = os.path.dirname(path)
+
+        with open(os.path.join(directory, 'metadata.yaml')) as f:
+            self.names = yaml.safe_load(f)['names']
+
+        core = ov.Core()
+        model = core.read_model(path)
+        config = {'PERFORMANCE_HINT': 'LATENCY'}
+        if threads is not None:
+            config['INFERENCE_NUM_THREADS'] = threads
+        self.compiled = core.compile_model(model, 'CPU', config)
+
+        input_shape = model.inputs[0].get_partial_shape()
+        self.dynamic_batch = input_shape[0].is_dynamic
+        self.fixed_imgsz = None if input_shape[2].is_dynamic else input_shape[2].get_length()
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        return self.compiled(batch)[0]
+
+# Picks the backend from the kind of model file given:
+# `.pt` weights run on PyTorch, `.onnx` files on ONNX Runtime,
+# and OpenVINO `.xml` files (or their export directories) on OpenVINO.
+def load_detector(path: str, threads: Optional[int] = None, warmup: bool = True) -> Detector:
+    if path.endswith('.onnx'):
+        detector = OnnxDetector(path, threads)
+    elif path.endswith('.xml') or os.path.isdir(path):
+        detector = OpenVinoDetector(path, threads)
+    else:
+        detector = TorchDetector(path, threads)
+    if warmup:
+        detector.warmup()
+    return detector
@@ -0,0 +1,43 @@
+from collections import deque, namedtuple
+import json
+import threading
+from typing import Any, Dict, List, Optional
+
+Event = namedtuple('Event', ['id', 'type', 'data'])
+
+# An append-only log of the events published for one session, numbered from 1.
+# Only the most recent `capacity` events are kept for replaying to reconnecting clients.
+class EventLog:
+    def __init__(self, capacity: int = 512):
+        self.events = deque(maxlen=capacity)
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def publish(self, event_type: str, data: Dict[str, Any]) -> Event:
+        with self.condition:
+            self.last_id += 1
+            event = Event(self.last_id, event_type, data)
+            self.events.append(event)
+            self.condition.notify_all()
+        return event
+
+    # The events after `cursor`, or `None` if some of them have already been dropped from the log,
+    # or if the cursor is from a different log (e.g. one from before a server restart or session eviction),
+    # in which case the client has to be resynchronised from a snapshot instead.
+    def since(self, cursor: int) -> Optional[List[Event]]:
+        with self.condition:
+            if cursor > self.last_id or (self.events and cursor < self.events[0].id - 1):
+                return None
+            return [event for event in self.events if event.id > cursor]
+
+    # As above, but blocks for up to `timeout` seconds until there is at least one new event.
+    def wait(self, cursor: int, timeout: float) -> Optional[List[Event]]:
+        with self.condition:
+            self.condition.wait_for(lambda: self.last_id != cursor, timeout=timeout)
+        return self.since(cursor)
+
+def sse_message(event: Event) -> str:
+    return f'id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.data)}\n\n'
+
+# Sent periodically so that proxies and browsers keep idle connections open.
+SSE_KEEP_ALIVE = ': keep-alive\n\n'
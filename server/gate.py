@@ -0,0 +1,112 @@
+import chess
+import cv2
+import numpy as np
+from typing import List, Optional, Tuple
+
+from server.types import GateDecision
+
+# The names reported to the client for each gate decision.
+GATE_DECISION_NAMES = {
+    GateDecision.Inferred: 'inferred',
+    GateDecision.Unchanged: 'unchanged',
+    GateDecision.InMotion: 'in-motion',
+}
+
+def downsample(image: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    return cv2.resize(grey, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+# The fraction of pixels that differ noticeably between two downsampled frames.
+def changed_fraction(a: np.ndarray, b: np.ndarray, pixel_threshold: int) -> float:
+    return np.count_nonzero(np.abs(a - b) > pixel_threshold) / a.size
+
+# The part of an image inside a normalised (left, top, right, bottom) region.
+Region = Tuple[float, float, float, float]
+
+# A cheap check run before model inference.
+# Each frame is shrunk to a small greyscale thumbnail and compared with
+# the thumbnail of the last frame that was actually inferred (the reference).
+# If nothing has changed since then, the cached board reading can be reused.
+# If something has changed but the scene is still moving (e.g. a hand is over the board),
+# inference is deferred until the scene has been stable for `stable_frames` consecutive frames.
+#
+# Once the board has been located, the caller passes its `region` along with the reading,
+# and only that region is compared, at `board_size`. A single moved piece then changes
+# a few percent of the thumbnail, rather than a fraction of a percent of the whole frame
+# (which the default `change_threshold` would not reliably tell apart from no change),
+# and movement away from the board no longer triggers inference.
+class MotionGate:
+    def __init__(
+            self,
+            size: Tuple[int, int] = (128, 72),
+            board_size: Tuple[int, int] = (96, 96),
+            pixel_threshold: int = 20,
+            change_threshold: float = 0.001,
+            stable_frames: int = 1):
+        self.size = size
+        self.board_size = board_size
+        self.pixel_threshold = pixel_threshold
+        self.change_threshold = change_threshold
+        self.stable_frames = stable_frames
+
+        self.region: Optional[Region] = None
+        self.reference: Optional[np.ndarray] = None
+        self.reading: Optional[List[Optional[chess.Piece]]] = None
+        self.image: Optional[np.ndarray] = None
+        self.previous: Optional[np.ndarray] = None
+        self.stable_count = 0
+
+    @staticmethod
+    def crop(image: np.ndarray, region: Region) -> np.ndarray:
+        height, width = image.shape[:2]
+        left, top, right, bottom = region
+        return image[int(top * height):int(np.ceil(bottom * height)), int(left * width):int(np.ceil(right * width))]
+
+    def thumbnail(self, image: np.ndarray) -> np.ndarray:
+        if self.region is None:
+            return downsample(image, self.size)
+        return downsample(self.crop(image, self.region), self.board_size)
+
+    def differs(self, a: np.ndarray, b: np.ndarray) -> bool:
+        return changed_fraction(a, b, self.pixel_threshold) >= self.change_threshold
+
+    def observe(self, image: np.ndarray) -> GateDecision:
+        thumbnail = self.thumbnail(image)
+        previous, self.previous = self.previous, thumbnail
+        self.image = image
+
+        # Without a cached reading, there is nothing to fall back on.
+        if self.reference is None or self.reading is None:
+            return GateDecision.Inferred
+
+        if not self.differs(thumbnail, self.reference):
+            self.stable_count = 0
+            return GateDecision.Unchanged
+
+        if previous is None or self.differs(thumbnail, previous):
+            self.stable_count = 0
+        else:
+            self.stable_count += 1
+
+        if self.stable_count < self.stable_frames:
+            return GateDecision.InMotion
+        return GateDecision.Inferred
+
+    # Called once inference has succeeded on the most recently observed frame,
+    # with the board's region in that frame if it is known.
+    def record(self, reading: List[Optional[chess.Piece]], region: Optional[Region] = None):
+        if region != self.region:
+            self.region = region
+            self.previous = None if self.image is None else self.thumbnail(self.image)
+        self.reference = self.previous
+        self.reading = reading
+        self.stable_count = 0
+
+    # Forgets the reference and the board's region, e.g. when the camera is changed.
+    def clear(self):
+        self.region = None
+        self.reference = None
+        self.reading = None
+        self.image = None
+        self.previous = None
+        self.stable_count = 0
@@ -0,0 +1,130 @@
+import numpy as np
+from typing import Optional, Tuple
+
+# Board space places the board at [0, 8] x [0, 8], with one unit per square.
+# The first axis follows the image x-axis and the second follows the image y-axis,
+# so that (0, 0) is the top-left corner of the board in the image.
+#
+# We assume we are viewing the board such that H8 is the top-left
+# and that A1 is the bottom-right.
+# Visually, the top row is H8, H7, H6, ...
+# `SQUARE_INDEX[row, column]` is the square (coded to be little endian, for compatibility with `chess`)
+# at the given row and column of board space.
+SQUARE_INDEX = np.array([[(7 - column) * 8 + (7 - row) for column in range(8)] for row in range(8)])
+
+# The centre of each square in board space, as (x, y), in the same row-major order as `SQUARE_INDEX`.
+SQUARE_CENTRES = np.array([[column + 0.5, row + 0.5] for row in range(8) for column in range(8)])
+
+# Overlaps (in squares of board space) closer than this are treated as equal.
+AREA_TOLERANCE = 1e-9
+
+BOARD_SPACE_CORNERS = np.array([[0, 0], [8, 0], [8, 8], [0, 8]], dtype=np.float64)
+
+# Orders four corner points as top-left, top-right, bottom-right, bottom-left (clockwise on screen).
+def order_corners(points: np.ndarray) -> np.ndarray:
+    centre = points.mean(axis=0)
+    angles = np.arctan2(points[:, 1] - centre[1], points[:, 0] - centre[0])
+    clockwise = points[np.argsort(angles)]
+    top_left = np.argmin(clockwise.sum(axis=1))
+    return np.roll(clockwise, -top_left, axis=0)
+
+# The axis-aligned fit: the board is taken to be the bounding box of the corners.
+def bounding_homography(corners: np.ndarray) -> np.ndarray:
+    (x1, y1), (x2, y2) = corners.min(axis=0), corners.max(axis=0)
+    return np.array([
+        [8 / (x2 - x1), 0, -8 * x1 / (x2 - x1)],
+        [0, 8 / (y2 - y1), -8 * y1 / (y2 - y1)],
+        [0, 0, 1],
+    ])
+
+# Solves for the perspective transform taking four points exactly onto four others.
+def perspective_homography(source: np.ndarray, target: np.ndarray) -> np.ndarray:
+    a = np.zeros((8, 8))
+    b = np.zeros(8)
+    for k, ((x, y), (u, v)) in enumerate(zip(source, target)):
+        a[2 * k] = [x, y, 1, 0, 0, 0, -u * x, -u * y]
+        a[2 * k + 1] = [0, 0, 0, x, y, 1, -v * x, -v * y]
+        b[2 * k], b[2 * k + 1] = u, v
+    return np.append(np.linalg.solve(a, b), 1).reshape(3, 3)
+
+# Fits the transform from normalised image coordinates to board space.
+# With all four corners visible, a full perspective homography is fitted.
+# Otherwise (or if the four corners are degenerate), the board is assumed to be axis-aligned.
+def fit_homography(corners: np.ndarray) -> np.ndarray:
+    if len(corners) == 4:
+        try:
+            return perspective_homography(order_corners(corners), BOARD_SPACE_CORNERS)
+        except np.linalg.LinAlgError:
+            pass
+    return bounding_homography(corners)
+
+def project(homography: np.ndarray, points: np.ndarray) -> np.ndarray:
+    projected = np.hstack([points, np.ones((len(points), 1))]) @ homography.T
+    return projected[:, :2] / projected[:, 2:]
+
+# Assigns each box (given as normalised xywh) to the square it overlaps the most, in one pass.
+# Every box is projected into board space, and the overlap of its extent with each of the
+# 64 squares is computed as an (N, 8, 8) intersection-area matrix.
+# Returns the square of each box, and whether the box overlaps the board at all.
+def assign_squares(homography: np.ndarray, xywhn: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if len(xywhn) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=bool)
+    x, y, w, h = xywhn.T
+    box_corners = np.stack([
+        np.stack([x - w / 2, y - h / 2], axis=1),
+        np.stack([x + w / 2, y - h / 2], axis=1),
+        np.stack([x + w / 2, y + h / 2], axis=1),
+        np.stack([x - w / 2, y + h / 2], axis=1),
+    ], axis=1)
+    projected = project(homography, box_corners.reshape(-1, 2)).reshape(-1, 4, 2)
+    low, high = projected.min(axis=1), projected.max(axis=1)
+
+    edges = np.arange(8)
+    x_overlap = np.clip(np.minimum(high[:, 0:1], edges + 1) - np.maximum(low[:, 0:1], edges), 0, None)
+    y_overlap = np.clip(np.minimum(high[:, 1:2], edges + 1) - np.maximum(low[:, 1:2], edges), 0, None)
+    areas = (y_overlap[:, :, None] * x_overlap[:, None, :]).reshape(-1, 64)
+
+    # Overlaps within `AREA_TOLERANCE` of the largest count as ties (e.g. a tall box covering two squares fully),
+    # which go to the tied square nearest the centre of the box rather than to whichever rounding error is larger.
+    largest = areas.max(axis=1)
+    centres = (low + high) / 2
+    distances = ((SQUARE_CENTRES[None, :, :] - centres[:, None, :]) ** 2).sum(axis=2)
+    best = np.argmin(np.where(areas >= largest[:, None] - AREA_TOLERANCE, distances, np.inf), axis=1)
+    return SQUARE_INDEX.reshape(-1)[best], largest > 0
+
+# Caches the fitted homography across frames from a camera that is not moving.
+# As long as every detected corner lies within `tolerance` (in normalised image units)
+# of a corner used for the cached fit, the cached homography is reused,
+# which also keeps a good four-corner fit while one corner is briefly occluded.
+class BoardGeometry:
+    def __init__(self, tolerance: float = 0.01):
+        self.tolerance = tolerance
+        self.corners: Optional[np.ndarray] = None
+        self.cached: Optional[np.ndarray] = None
+
+    def matches_cache(self, corners: np.ndarray) -> bool:
+        if self.corners is None or len(corners) > len(self.corners):
+            return False
+        distances = np.linalg.norm(corners[:, None, :] - self.corners[None, :, :], axis=2)
+        return bool(np.all(distances.min(axis=1) <= self.tolerance))
+
+    def homography(self, corners: np.ndarray) -> np.ndarray:
+        if not self.matches_cache(corners):
+            self.cached = fit_homography(corners)
+            self.corners = corners
+        return self.cached
+
+    # The bounding box of the board in the image, as a normalised (left, top, right, bottom) region,
+    # extended by `margin` squares on each side for the height of the pieces. `None` until the board is located.
+    def region(self, margin: float = 1.0) -> Optional[Tuple[float, float, float, float]]:
+        if self.cached is None:
+            return None
+        extended = BOARD_SPACE_CORNERS + np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * margin
+        corners = project(np.linalg.inv(self.cached), extended)
+        left, top = np.clip(corners.min(axis=0), 0, 1)
+        right, bottom = np.clip(corners.max(axis=0), 0, 1)
+        return float(left), float(top), float(right), float(bottom)
+
+    def clear(self):
+        self.corners = None
+        self.cached = None
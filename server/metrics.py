@@ -0,0 +1,201 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Minimal Prometheus-style metrics, rendered in the text exposition format for the `/metrics` endpoint.
+# Everything is recorded in the process-wide `METRICS` registry, which starts disabled:
+# until it is enabled, recording a value only costs a flag check, and timers do not read the clock.
+
+# Latency buckets (in seconds) spanning a cached move match up to a slow CPU inference.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names: List[str], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: List[str]):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series: Dict[LabelValues, object] = {}
+
+    def key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    # Drops every series with the given label value, e.g. when a session is evicted.
+    def forget(self, label: str, value: str):
+        if label not in self.labels:
+            return
+        index = self.labels.index(label)
+        with self.lock:
+            for key in [key for key in self.series if key[index] == value]:
+                del self.series[key]
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        pass
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            series = sorted(self.series.items())
+        return [f'{self.name}{format_labels(self.labels, key)} {value:g}' for key, value in series]
+
+# Each series keeps a count per bucket (not cumulative), plus the running sum and count.
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: List[str], buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str):
+        key = self.key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        with self.lock:
+            series = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self.series.items())
+        lines = []
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                bucket_labels = format_labels(self.labels, key, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {total:g}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {count}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.enabled = False
+        self.metrics: Dict[str, Metric] = {}
+
+    def counter(self, name: str, documentation: str, labels: List[str]) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: List[str], buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def forget(self, label: str, value: str):
+        for metric in self.metrics.values():
+            metric.forget(label, value)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+METRICS = MetricsRegistry()
+METRICS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = METRICS.histogram(
+    'memochess_stage_seconds',
+    'Time spent in each stage of handling a frame.',
+    ['stage', 'board'])
+MOVE_ERRORS = METRICS.counter(
+    'memochess_move_errors_total',
+    'Frames that could not be turned into a move, by error class.',
+    ['error', 'board'])
+GATE_DECISIONS = METRICS.counter(
+    'memochess_gate_decisions_total',
+    'Frames seen by the motion gate, by decision.',
+    ['decision', 'board'])
+FRAMES_SHED = METRICS.counter(
+    'memochess_frames_shed_total',
+    'Frames dropped because the previous frame of the same board was still being read.',
+    ['board'])
+CAPTURE_MISSES = METRICS.counter(
+    'memochess_capture_misses_total',
+    'Requests for a frame for which no fresh frame was available.',
+    ['webcam'])
+CAPTURE_RECONNECTS = METRICS.counter(
+    'memochess_capture_reconnects_total',
+    'Times a webcam reader lost its connection and had to reconnect.',
+    ['webcam'])
+
+# The board whose frame is currently being handled, for labelling stages deep in the pipeline
+# (such as inference and move matching) that do not otherwise know which session they serve.
+CURRENT_BOARD: ContextVar[str] = ContextVar('memochess_board', default='')
+
+@contextmanager
+def board_label(board_id: str) -> Iterator[None]:
+    token = CURRENT_BOARD.set(board_id)
+    try:
+        yield
+    finally:
+        CURRENT_BOARD.reset(token)
+
+class StageTimer:
+    def __init__(self, stage: str, board: Optional[str]):
+        self.stage = stage
+        self.board = CURRENT_BOARD.get() if board is None else board
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, stage=self.stage, board=self.board)
+
+# Shared by every stage timed while metrics are disabled.
+NULL_TIMER = nullcontext()
+
+def time_stage(stage: str, board: Optional[str] = None):
+    return StageTimer(stage, board) if METRICS.enabled else NULL_TIMER
+
+# Decorator form of `time_stage`.
+def timed(stage: str) -> Callable[[Callable], Callable]:
+    def decorator(f: Callable) -> Callable:
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return f(*args, **kwargs)
+            with time_stage(stage):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(counter: Counter, **labels: str):
+    if METRICS.enabled:
+        if 'board' in counter.labels and 'board' not in labels:
+            labels['board'] = CURRENT_BOARD.get()
+        counter.inc(**labels)
@@ -1,16 +1,14 @@
 import chess
-from collections import namedtuple
-from itertools import product
+import cv2
 import numpy as np
-from ultralytics import YOLO
-from typing import List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
+from server.detector import Detector
+from server.geometry import BOARD_SPACE_CORNERS, BoardGeometry, assign_squares, fit_homography, project
+from server.metrics import time_stage
+from server.state import Placement, PlacedReading
 from server.types import ImageConversionException
 
-Point = namedtuple('Point', ['x', 'y'])
-BoundingBox = namedtuple('BoundingBox', ['x', 'y', 'w', 'h'])
-BoxPrediction = namedtuple('BoxPrediction', ['name', 'conf', 'bounding_box'])
-
 LABEL_TO_PIECE_MAP = {
     'white pawn':   chess.Piece(chess.PAWN,   chess.WHITE),
     'white knight': chess.Piece(chess.KNIGHT, chess.WHITE),
@@ -26,90 +24,251 @@ LABEL_TO_PIECE_MAP = {
     'black king':   chess.Piece(chess.KING,   chess.BLACK),
 }
 
-def maximum_bounding_square(corners: List[BoundingBox]) -> Tuple[Point, Point]:
-    p1 = Point(x=min(p.x for p in corners), y=min(p.y for p in corners))
-    p2 = Point(x=max(p.x for p in corners), y=max(p.y for p in corners))
-    return p1, p2
+# The corners to fit the board to, as normalised (x, y) image coordinates.
+def corner_points(xywhn: np.ndarray, labels: List[str]) -> np.ndarray:
+    corners = xywhn[[label == 'corner' for label in labels], :2]
+    if len(corners) < 3:
+        raise ImageConversionException('Less than 3 corners detected')
+    return corners
 
-def intersection_area(box_a: BoundingBox, box_b: BoundingBox) -> float:
-    a1 = Point(box_a.x - 0.5 * box_a.w, box_a.y - 0.5 * box_a.h)
-    a2 = Point(box_a.x + 0.5 * box_a.w, box_a.y + 0.5 * box_a.h)
-    b1 = Point(box_b.x - 0.5 * box_b.w, box_b.y - 0.5 * box_b.h)
-    b2 = Point(box_b.x + 0.5 * box_b.w, box_b.y + 0.5 * box_b.h)
+# The piece seen on each occupied square, with the confidence of its detection.
+SquareDetections = Dict[int, Tuple[chess.Piece, float]]
 
-    x_overlap = max(0, min(a2.x, b2.x) - max(a1.x, b1.x))
-    y_overlap = max(0, min(a2.y, b2.y) - max(a1.y, b1.y))
+def detections_to_squares(
+        xywhn: np.ndarray,
+        confs: np.ndarray,
+        labels: List[str],
+        homography: np.ndarray) -> SquareDetections:
 
-    return x_overlap * y_overlap
+    squares_seen = {}
 
-def yolo_image_to_board(
-        model: YOLO,
-        image: np.ndarray) -> Tuple[List[Optional[chess.Piece]], np.ndarray]:
+    # We ignore all predictions of corners, then find the square
+    # that each remaining bounding box overlaps with the most.
+    piece_indices = np.array([i for i, label in enumerate(labels) if label != 'corner'], dtype=int)
+    squares, on_board = assign_squares(homography, xywhn[piece_indices])
+    piece_indices, squares = piece_indices[on_board], squares[on_board]
 
+    # If multiple pieces are guessed on the same square, we keep the guess with the highest confidence.
+    # Sorting stably by descending confidence means the first guess seen for each square is the one kept.
+    order = np.argsort(-confs[piece_indices], kind='stable')
+    kept_squares, first = np.unique(squares[order], return_index=True)
+    for square, index in zip(kept_squares, piece_indices[order][first]):
+        squares_seen[int(square)] = (LABEL_TO_PIECE_MAP[labels[index]], float(confs[index]))
+
+    return squares_seen
+
+def squares_to_board(squares: SquareDetections) -> List[Optional[chess.Piece]]:
     board_representation = [None] * 64
-    # Coded to be little endian (for compatibility with `chess`)
-    square_names_to_board = dict(zip((f+r for r, f in product('12345678', 'abcdefgh')), range(64)))
+    for square, (piece, _) in squares.items():
+        board_representation[square] = piece
+    return board_representation
+
+def detections_to_board(
+        xywhn: np.ndarray,
+        confs: np.ndarray,
+        labels: List[str],
+        homography: np.ndarray) -> List[Optional[chess.Piece]]:
+    return squares_to_board(detections_to_squares(xywhn, confs, labels, homography))
 
+def predict_detections(
+        model: Detector,
+        image: np.ndarray,
+        imgsz: int = 640,
+        conf: float = 0.25) -> Tuple[np.ndarray, np.ndarray, List[str], Callable[[], np.ndarray]]:
     # We conduct the model inference here and extract the predictions.
-    result = model.predict(image, imgsz=640, conf=0.25, verbose=False)[0]
-    result_plot = result.plot()
-    boxes = result.boxes
-    box_predictions = [
-        BoxPrediction(result.names[cls.item()], conf, BoundingBox(*(i.item() for i in xywh)))
-        for xywh, conf, cls in zip(boxes.xywhn, boxes.conf, boxes.cls)
-    ]
+    # The annotated image is returned as a callable, since it is only drawn if someone is watching it.
+    with time_stage('inference'):
+        detections = model.detect([image], imgsz=imgsz, conf=conf)[0]
+    labels = [detections.names[int(cls)] for cls in detections.cls]
+    return detections.xywhn, detections.conf, labels, detections.plot
 
-    corners = [p.bounding_box for p in box_predictions if p.name == 'corner']
+def yolo_image_to_squares(
+        model: Detector,
+        image: np.ndarray,
+        geometry: Optional[BoardGeometry] = None,
+        imgsz: int = 640,
+        conf: float = 0.25) -> Tuple[SquareDetections, Callable[[], np.ndarray]]:
+    xywhn, confs, labels, plot = predict_detections(model, image, imgsz, conf)
 
-    if len(corners) < 3:
-        raise ImageConversionException('Less than 3 corners detected')
+    # We fit the mapping from the image to the board based on the corners,
+    # reusing the previous fit if the camera and board have not moved.
+    corners = corner_points(xywhn, labels)
+    homography = geometry.homography(corners) if geometry is not None else fit_homography(corners)
+
+    return detections_to_squares(xywhn, confs, labels, homography), plot
+
+def yolo_image_to_board(
+        model: Detector,
+        image: np.ndarray,
+        geometry: Optional[BoardGeometry] = None) -> Tuple[List[Optional[chess.Piece]], Callable[[], np.ndarray]]:
+    squares, plot = yolo_image_to_squares(model, image, geometry)
+    return squares_to_board(squares), plot
+
+# The running contents of each square of one board, carried from one reading to the next.
+#
+# A square only takes a different piece when that piece is detected on it with at least `switch_conf`.
+# Weaker detections only keep a piece that was already there (unless that would leave more pieces
+# of its kind than there were before the frame); a weak detection of anything else empties the square.
+# So pieces already seen don't flicker out when their detections dip below `switch_conf` for a frame,
+# and weak misdetections never put pieces on the board.
+# Only the squares whose contents change are rewritten, along with their bits of the placement,
+# so each reading is handed to the move matcher with its placement already built.
+class SquareState:
+    def __init__(self, switch_conf: float = 0.25):
+        self.switch_conf = switch_conf
+        self.pieces: List[Optional[chess.Piece]] = [None] * 64
+        self.placement: Placement = (0,) * 8
+        self.occupied = 0
+
+    def update(self, squares: SquareDetections) -> PlacedReading:
+        changed = 0
+        weakly_kept: List[Tuple[float, chess.Square]] = []
+        for sq in set(squares).union(chess.scan_forward(self.occupied)):
+            seen, conf = squares.get(sq, (None, 0.0))
+            if seen is not None and conf < self.switch_conf:
+                if seen == self.pieces[sq]:
+                    weakly_kept.append((conf, sq))
+                    continue
+                seen = None
+            if seen != self.pieces[sq]:
+                self.pieces[sq] = seen
+                changed |= chess.BB_SQUARES[sq]
+
+        # A piece that has just moved can leave a fading duplicate detection on the square it came from.
+        # Pieces don't multiply, so if confidently placing pieces made more of a kind than there were,
+        # the weakest detections only keeping pieces of that kind are taken as such duplicates and emptied.
+        if changed and weakly_kept:
+            before = self.counts()
+            self.apply(changed)
+            extra = {piece: count - before.get(piece, 0) for piece, count in self.counts().items()}
+            for _, sq in sorted(weakly_kept):
+                piece = self.pieces[sq]
+                if extra.get(piece, 0) > 0:
+                    extra[piece] -= 1
+                    self.pieces[sq] = None
+                    changed |= chess.BB_SQUARES[sq]
+        if changed:
+            self.apply(changed)
+
+        reading = PlacedReading(self.pieces)
+        reading.placement = self.placement
+        return reading
+
+    def apply(self, changed: int):
+        bitboards = [bitboard & ~changed for bitboard in self.placement]
+        for sq in chess.scan_forward(changed):
+            piece = self.pieces[sq]
+            if piece is not None:
+                bit = chess.BB_SQUARES[sq]
+                bitboards[piece.piece_type - 1] |= bit
+                bitboards[6 if piece.color == chess.WHITE else 7] |= bit
+        self.placement = tuple(bitboards)
+        self.occupied = self.placement[6] | self.placement[7]
+
+    def counts(self) -> Dict[chess.Piece, int]:
+        return {chess.Piece(piece_type, color): chess.popcount(self.placement[piece_type - 1] & self.placement[6 if color else 7])
+                for piece_type in chess.PIECE_TYPES for color in chess.COLORS}
+
+# Reads boards from the frames of a single camera, keeping whatever geometry it has learned between frames.
+#
+# With `two_stage` enabled, the board is first located on the full frame (as in `yolo_image_to_board`),
+# and subsequent frames are cropped and rectified to just the board (plus a `margin` of squares on each side)
+# before running piece detection on that crop only, at `crop_imgsz`.
+# The board is located again on the full frame every `redetect_interval` frames,
+# or immediately if the corners seen in the crop no longer line up with where the board should be.
+#
+# Detection runs at `imgsz` on full frames, keeping detections of at least `conf`.
+# With `track_squares`, readings are carried forward square by square through a `SquareState`,
+# which only puts a different piece on a square for detections of at least `switch_conf`.
+# With `conf` equal to `switch_conf` this reads exactly as without tracking,
+# and lowering `conf` lets weaker detections keep pieces that were already seen.
+class BoardReader:
+    def __init__(
+            self,
+            two_stage: bool = False,
+            imgsz: int = 640,
+            conf: float = 0.25,
+            track_squares: bool = True,
+            switch_conf: float = 0.25,
+            crop_size: int = 640,
+            crop_imgsz: int = 640,
+            margin: float = 1.0,
+            redetect_interval: int = 30,
+            corner_tolerance: float = 0.5,
+            geometry_tolerance: float = 0.01):
+        self.two_stage = two_stage
+        self.imgsz = imgsz
+        self.conf = conf
+        self.squares = SquareState(switch_conf) if track_squares else None
+        self.crop_size = crop_size
+        self.crop_imgsz = crop_imgsz
+        self.margin = margin
+        self.redetect_interval = redetect_interval
+        self.corner_tolerance = corner_tolerance
+        self.geometry = BoardGeometry(geometry_tolerance)
+        self.frames_since_located: Optional[int] = None
+
+    # Forgets where the board is, e.g. when the camera is changed.
+    def clear(self):
+        self.geometry.clear()
+        self.frames_since_located = None
+
+    def read(self, model: Detector, image: np.ndarray) -> Tuple[List[Optional[chess.Piece]], Callable[[], np.ndarray]]:
+        squares, plot = self.read_squares(model, image)
+        if self.squares is None:
+            return squares_to_board(squares), plot
+        return self.squares.update(squares), plot
+
+    def read_squares(self, model: Detector, image: np.ndarray) -> Tuple[SquareDetections, Callable[[], np.ndarray]]:
+        if not self.two_stage:
+            return yolo_image_to_squares(model, image, self.geometry, self.imgsz, self.conf)
+        if self.frames_since_located is not None and self.frames_since_located < self.redetect_interval:
+            self.frames_since_located += 1
+            reading = self.read_crop(model, image)
+            if reading is not None:
+                return reading
+        return self.locate(model, image)
+
+    def locate(self, model: Detector, image: np.ndarray) -> Tuple[SquareDetections, Callable[[], np.ndarray]]:
+        self.frames_since_located = None
+        # If the board cannot be found, this raises and the next frame tries again.
+        reading = yolo_image_to_squares(model, image, self.geometry, self.imgsz, self.conf)
+        self.frames_since_located = 0
+        return reading
+
+    # Maps board space to pixels of the crop, leaving `margin` squares around the board.
+    def crop_transform(self) -> np.ndarray:
+        scale = self.crop_size / (8 + 2 * self.margin)
+        return np.array([
+            [scale, 0, scale * self.margin],
+            [0, scale, scale * self.margin],
+            [0, 0, 1],
+        ])
+
+    # Returns `None` if the crop looks inconsistent with the cached board location.
+    def read_crop(self, model: Detector, image: np.ndarray) -> Optional[Tuple[SquareDetections, Callable[[], np.ndarray]]]:
+        height, width = image.shape[:2]
+        to_normalised = np.diag([1 / width, 1 / height, 1])
+        warp = self.crop_transform() @ self.geometry.cached @ to_normalised
+        crop = cv2.warpPerspective(image, warp, (self.crop_size, self.crop_size))
+
+        xywhn, confs, labels, plot = predict_detections(model, crop, self.crop_imgsz, self.conf)
+
+        # Normalised crop coordinates map linearly onto board space.
+        extent = 8 + 2 * self.margin
+        crop_homography = np.array([
+            [extent, 0, -self.margin],
+            [0, extent, -self.margin],
+            [0, 0, 1],
+        ])
+
+        # The corners seen in the crop should sit on the corners of board space.
+        corners = xywhn[[label == 'corner' for label in labels], :2]
+        if len(corners) < 3:
+            return None
+        corners = project(crop_homography, corners)
+        distances = np.linalg.norm(corners[:, None, :] - BOARD_SPACE_CORNERS[None, :, :], axis=2)
+        if np.count_nonzero(distances.min(axis=0) <= self.corner_tolerance) < 3:
+            return None
 
-    # Need to calculate the bounds here based on the corners.
-    corner1, corner2 = maximum_bounding_square(corners)
-    entire_grid_bb = BoundingBox(
-        x=(corner1.x + corner2.x)/2,
-        y=(corner1.y + corner2.y)/2,
-        w=corner2.x - corner1.x,
-        h=corner2.y - corner1.y)
-
-    # Then, we map a square in the image region to a particular square in the board.
-    # We assume we are viewing the board such that H8 is the top-left
-    # and that A1 is the bottom-right.
-    x_step = (corner2.x - corner1.x) / 8
-    y_step = (corner2.y - corner1.y) / 8
-    x_points = [corner1.x + i * x_step for i in range(8)]
-    y_points = [corner1.y + i * y_step for i in range(8)]
-
-    # Visually, the top row is H8, H7, H6, ...
-    square_names = (f+r for f, r in product('hgfedcba', '87654321'))
-    square_regions = (BoundingBox(x + 0.5 * x_step, y + 0.5 * y_step, x_step, y_step)
-        for y, x in product(y_points, x_points))
-    grid_boxes = dict(zip(square_names, square_regions))
-
-    for box_prediction in box_predictions:
-        # We ignore all predictions of corners.
-        if box_prediction.name == 'corner':
-            continue
-
-        if intersection_area(entire_grid_bb, box_prediction.bounding_box) == 0:
-            continue
-
-        # We then find the piece, its bounding box and its confidence.
-        piece_type = LABEL_TO_PIECE_MAP[box_prediction.name]
-        bounding_box = box_prediction.bounding_box
-        confidence = box_prediction.conf
-
-        # We then find the square that our bounding box overlaps with the most.
-        closest_square = max(
-            grid_boxes.keys(),
-            key=lambda sq: intersection_area(grid_boxes[sq], bounding_box))
-        closest_square_name = square_names_to_board[closest_square]
-
-        # We then check if this square was previously guessed to be another piece,
-        # and we overwrite that guess if we have a higher confidence this time.
-        previous_guess = board_representation[closest_square_name]
-        if previous_guess is None or previous_guess[1] < confidence:
-            board_representation[closest_square_name] = (piece_type, confidence)
-
-    # Remove the confidence guesses at the end.
-    return [None if piece is None else piece[0] for piece in board_representation], result_plot
+        return detections_to_squares(xywhn, confs, labels, crop_homography), plot
@@ -0,0 +1,68 @@
+import threading
+import time
+import traceback
+
+from server.capture import CaptureRegistry
+from server.detector import Detector
+from server.metrics import board_label, time_stage
+from server.session import Session
+from server.types import MoveState
+
+# A background thread that keeps reading one session's board and publishing what it sees,
+# so that inference runs once per board however many clients are watching its events.
+# Each client watching the board is counted in `watchers`, and the loop is stopped when the last one leaves.
+# It also stops by itself once the game has concluded,
+# or once no client has touched the session for `idle_timeout` seconds (e.g. if watchers vanished without leaving).
+class RecognitionLoop:
+    def __init__(
+            self,
+            session: Session,
+            model: Detector,
+            captures: CaptureRegistry,
+            interval: float = 1.0,
+            idle_timeout: float = 5 * 60):
+        self.session = session
+        self.model = model
+        self.captures = captures
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.watchers = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name=f'recognition-{session.board_id}', daemon=True)
+        self.thread.start()
+
+    def is_alive(self) -> bool:
+        return self.thread.is_alive() and not self.stopped.is_set()
+
+    def stop(self):
+        self.stopped.set()
+
+    def step(self):
+        session = self.session
+        with board_label(session.board_id), session.frame_slot() as free:
+            if free:
+                with time_stage('capture'):
+                    captured = self.captures.latest_frame(session.webcam) if session.webcam else None
+                with session.lock:
+                    if captured is None:
+                        session.set_move_state(MoveState(move=None, exact=True, error='no-capture'))
+                    else:
+                        session.advance(self.model, captured.frame)
+        with session.lock:
+            return session.board.result() == '*'
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if time.monotonic() - self.session.last_access > self.idle_timeout:
+                break
+            # A failure outside of reading the board (e.g. while capturing) is reported, and the loop carries on.
+            try:
+                if not self.step():
+                    break
+            except Exception as err:
+                traceback.print_exc()
+                with self.session.lock:
+                    self.session.set_move_state(MoveState(
+                        move=None, exact=True, error=['recognition-failed', f'{type(err).__name__}: {err}']))
+        self.stopped.set()
@@ -0,0 +1,268 @@
+import chess
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import cache
+import numpy as np
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from server.api import gated_continuing_game
+from server.detector import Detector
+from server.events import EventLog
+from server.gate import GATE_DECISION_NAMES, MotionGate
+from server.metrics import FRAMES_SHED, GATE_DECISIONS, METRICS, MOVE_ERRORS, count, time_stage
+from server.read import BoardReader
+from server.state import PositionHistory, prime_move_index
+from server.types import *
+
+# Everything the server tracks for a single physical board.
+# All reads and writes of a session's state should happen while holding its `lock`,
+# so that concurrent requests for the same board are serialised
+# while requests for other boards proceed independently.
+# With `auto_rollback`, a live board found to match an earlier position of the game
+# (e.g. after a misread move, once the players have fixed the board) is rolled back to it straight away,
+# rather than the rollback being offered to the client.
+# Up to `max_plies` moves are recovered from a single frame, for when frames were missed between moves.
+class Session:
+    def __init__(
+            self,
+            board_id: str,
+            webcam: Optional[str] = None,
+            auto_rollback: bool = False,
+            max_plies: int = 2,
+            **reader_options):
+        self.board_id = board_id
+        self.webcam = webcam
+        self.auto_rollback = auto_rollback
+        self.max_plies = max_plies
+        self.board = chess.Board()
+        self.history = PositionHistory(self.board)
+        self.move_state = MoveState(move=None, exact=True, error=None)
+        self.gate = MotionGate()
+        self.reader = BoardReader(**reader_options)
+        self.lock = threading.Lock()
+        # Held while a frame of this board is being read, to shed any frames that arrive meanwhile.
+        self.advancing = threading.Lock()
+        self.last_access = time.monotonic()
+
+        # The annotated image of the most recent inference, drawn only if a client asks for it.
+        self.plot: Optional[Callable[[], np.ndarray]] = None
+        self.plot_timestamp = 0.0
+
+        # Changes to the session are published here for subscribed clients.
+        self.events = EventLog()
+        # The server-side recognition loop for this board, if one has been started.
+        self.loop = None
+
+    def record_plot(self, plot: Callable[[], np.ndarray]):
+        board_id = self.board_id
+
+        def draw() -> np.ndarray:
+            with time_stage('plot', board_id):
+                return plot()
+
+        # Memoised so that the annotation is drawn at most once, however many clients view it.
+        self.plot = cache(draw)
+        self.plot_timestamp = time.monotonic()
+
+    def san_moves(self) -> List[str]:
+        replay = self.board.root()
+        moves = []
+        for move in self.board.move_stack:
+            moves.append(replay.san(move))
+            replay.push(move)
+        return moves
+
+    # The full state of the game, sent to clients that need to (re)synchronise.
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'fen': self.board.fen(),
+            'moves': self.san_moves(),
+            'status': self.board.result(),
+        }
+
+    # Moves should be pushed and popped through the session rather than the board directly,
+    # so that the move index of the new position is built before its next frame arrives,
+    # and so that subscribed clients are told about the change.
+    def push(self, move: chess.Move, exact: bool = True, gate: str = 'inferred'):
+        san = self.board.san(move)
+        self.set_move_state(MoveState(move=san, exact=exact, error=None, gate=gate))
+        self.board.push(move)
+        self.history.push(self.board)
+        prime_move_index(self.board)
+        status = self.board.result()
+        self.events.publish('move', {
+            'san': san,
+            'uci': move.uci(),
+            'exact': exact,
+            'gate': gate,
+            'ply': len(self.board.move_stack),
+            'fen': self.board.fen(),
+            'status': status,
+            'repetition': self.board.is_repetition(),
+        })
+        if status != '*':
+            self.events.publish('result', {'status': status})
+
+    def pop(self) -> chess.Move:
+        move = self.board.pop()
+        self.history.pop()
+        prime_move_index(self.board)
+        self.set_move_state(MoveState(move=None, exact=True, error=None))
+        self.events.publish('fen', self.snapshot())
+        return move
+
+    def reset(self):
+        self.board = chess.Board()
+        self.history.reset(self.board)
+        self.set_move_state(MoveState(move=None, exact=True, error=None))
+        prime_move_index(self.board)
+        self.events.publish('fen', self.snapshot())
+
+    # Takes back every move after `ply`, publishing a single snapshot of the result.
+    def rollback(self, ply: int):
+        while len(self.board.move_stack) > ply:
+            self.board.pop()
+            self.history.pop()
+        prime_move_index(self.board)
+        self.set_move_state(MoveState(move=None, exact=True, error=None))
+        self.events.publish('fen', self.snapshot())
+
+    def set_move_state(self, move_state: MoveState):
+        # Errors are only published when they change (including when they clear),
+        # so that a board left in an erroneous position does not flood clients with repeats.
+        if move_state.error != self.move_state.error:
+            self.events.publish('error', {'error': move_state.error})
+        if move_state.error is not None:
+            error = move_state.error[0] if isinstance(move_state.error, list) else move_state.error
+            count(MOVE_ERRORS, error=error, board=self.board_id)
+        self.move_state = move_state
+
+    # Reads a new frame of this board, and registers the move played if there is one.
+    # This is the step shared by the `/continue` endpoint and the server-side recognition loop.
+    def advance(self, model: Detector, frame: np.ndarray):
+        try:
+            (moves, exact), pred_plot, decision = gated_continuing_game(
+                self.board, model, frame, self.gate, self.reader, self.history, self.max_plies)
+            if pred_plot is not None:
+                self.record_plot(pred_plot)
+            gate = GATE_DECISION_NAMES[decision]
+            count(GATE_DECISIONS, decision=gate, board=self.board_id)
+            if not moves:
+                self.set_move_state(MoveState(move=None, exact=True, error=None, gate=gate))
+            for move in moves:
+                self.push(move, exact, gate)
+        except ImageConversionException as err:
+            self.set_move_state(MoveState(
+                move=None, exact=True, error=['image-conversion', ' '.join(err.args)]))
+        except MoveIllegalException as err:
+            self.set_move_state(MoveState(
+                move=None, exact=True, error=['move-illegal', ' '.join(err.args)]))
+        except MoveImpossibleException as err:
+            self.set_move_state(MoveState(
+                move=None, exact=True, error=['move-impossible', ' '.join(err.args)]))
+        except EarlierPositionException as err:
+            message, ply = err.args
+            if self.auto_rollback:
+                self.rollback(ply)
+            else:
+                self.set_move_state(MoveState(
+                    move=None, exact=True, error=['rollback-available', message, ply]))
+        except InferenceBusyException as err:
+            self.set_move_state(MoveState(
+                move=None, exact=True, error=['busy', ' '.join(err.args)]))
+        # Anything else (e.g. a crashed inference worker) is reported rather than failing the request or loop.
+        except Exception as err:
+            traceback.print_exc()
+            self.set_move_state(MoveState(
+                move=None, exact=True, error=['inference-failed', f'{type(err).__name__}: {err}']))
+
+    # Wraps capturing and reading a frame of this board.
+    # Yields `False` if another frame of the board is still being captured or read, in which case
+    # the caller should drop its frame rather than queue it, so that a slow board only sheds its own load.
+    @contextmanager
+    def frame_slot(self) -> Iterator[bool]:
+        if not self.advancing.acquire(blocking=False):
+            count(FRAMES_SHED, board=self.board_id)
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.advancing.release()
+
+    # A different camera means a different view of the board, so nothing learned from the old one carries over.
+    def set_webcam(self, webcam: str):
+        self.webcam = webcam
+        self.gate.clear()
+        self.reader.clear()
+
+    def stop_loop(self):
+        if self.loop is not None:
+            self.loop.stop()
+            self.loop = None
+
+# Sessions keyed by board id, created on first use.
+# Sessions untouched for `idle_timeout` seconds are evicted.
+# Once `max_sessions` are live, a new board id only gets a session if the least recently used session
+# has been untouched for at least `reclaim_after` seconds (and is not running a recognition loop),
+# in which case that one is evicted; otherwise the new board is refused with `SessionLimitException`,
+# so that stray board ids can never evict games in progress.
+class SessionRegistry:
+    def __init__(
+            self,
+            max_sessions: int = 64,
+            idle_timeout: float = 6 * 60 * 60,
+            reclaim_after: float = 5 * 60,
+            **session_options):
+        self.session_options = session_options
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.reclaim_after = reclaim_after
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, board_id: str, webcam: Optional[str] = None) -> Session:
+        now = time.monotonic()
+        with self.lock:
+            self.evict(now)
+            session = self.sessions.get(board_id)
+            if session is None:
+                if len(self.sessions) >= self.max_sessions and not self.reclaim(now):
+                    raise SessionLimitException(f'{self.max_sessions} boards are already in use')
+                session = Session(board_id, webcam, **self.session_options)
+                self.sessions[board_id] = session
+            else:
+                self.sessions.move_to_end(board_id)
+            session.last_access = now
+        if webcam and webcam != session.webcam:
+            with session.lock:
+                session.set_webcam(webcam)
+        return session
+
+    # Must be called while holding `self.lock`.
+    # Sessions are kept in least to most recently used order, so eviction only inspects the front.
+    def evict(self, now: float):
+        while self.sessions:
+            board_id, oldest = next(iter(self.sessions.items()))
+            if now - oldest.last_access <= self.idle_timeout:
+                break
+            self.discard(board_id)
+
+    # Must be called while holding `self.lock`.
+    # Evicts the least recently used session that is idle enough to be reclaimed, returning whether there was one.
+    def reclaim(self, now: float) -> bool:
+        for board_id, session in self.sessions.items():
+            if now - session.last_access < self.reclaim_after:
+                return False
+            if session.loop is None or not session.loop.is_alive():
+                self.discard(board_id)
+                return True
+        return False
+
+    def discard(self, board_id: str):
+        session = self.sessions.pop(board_id)
+        session.stop_loop()
+        METRICS.forget('board', board_id)
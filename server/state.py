@@ -1,6 +1,10 @@
 import chess
-from typing import List, Optional, Set, Tuple, Union
+from collections import OrderedDict
+import random
+import threading
+from typing import Dict, List, Optional, Set, Tuple, Union
 
+from server.metrics import timed
 from server.types import MoveIllegalException, MoveImpossibleException
 
 def piece_list(b: chess.Board) -> List[Optional[chess.Piece]]:
@@ -21,78 +25,223 @@ def sqn(sq: Union[int, Set[int]]) -> str:
     else:
         return 'abcdefgh'[sq % 8] + '12345678'[sq // 8]
 
+# A piece placement as bitboards: one per piece type (pawn to king), then one per colour (white, black).
+# Two placements are equal exactly when their bitboards are, and the last two entries
+# (or their union) give the colour and occupancy views used by the looser matching stages.
+Placement = Tuple[int, int, int, int, int, int, int, int]
+
+def board_placement(b: chess.BaseBoard) -> Placement:
+    return (b.pawns, b.knights, b.bishops, b.rooks, b.queens, b.kings,
+            b.occupied_co[chess.WHITE], b.occupied_co[chess.BLACK])
+
+# A reading that carries its own placement, for readers that keep the placement up to date
+# square by square (see `SquareState` in `server/read.py`) instead of rebuilding it from all 64 squares.
+class PlacedReading(list):
+    placement: Placement
+
+def list_placement(pl: List[Optional[chess.Piece]]) -> Placement:
+    if isinstance(pl, PlacedReading):
+        return pl.placement
+    bitboards = [0] * 8
+    for sq, p in enumerate(pl):
+        if p is not None:
+            bit = chess.BB_SQUARES[sq]
+            bitboards[p.piece_type - 1] |= bit
+            bitboards[6 if p.color == chess.WHITE else 7] |= bit
+    return tuple(bitboards)
+
+# For a single position, every legal move indexed by the placement it results in.
+# `exact` and `colour` map a resulting placement (or just its colour bitboards)
+# to the first legal move that produces it, in `legal_moves` order.
+# `arrivals` lists every legal move by destination square, and `departures` every capture by origin square,
+# each with its position in `legal_moves` order and its resulting occupancy bitboard,
+# so that the looser matching stages only consider moves touching the squares that changed.
+class MoveIndex:
+    def __init__(self, b: chess.Board):
+        self.placement = board_placement(b)
+        self.exact: Dict[Placement, chess.Move] = {}
+        self.colour: Dict[Tuple[int, int], chess.Move] = {}
+        self.arrivals: Dict[int, List[Tuple[int, chess.Move, int]]] = {}
+        self.departures: Dict[int, List[Tuple[int, chess.Move, int]]] = {}
+
+        for order, move in enumerate(b.legal_moves):
+            is_capture = bool(b.occupied & chess.BB_SQUARES[move.to_square])
+            b.push(move)
+            placement = board_placement(b)
+            b.pop()
+            occupancy = placement[6] | placement[7]
+            self.exact.setdefault(placement, move)
+            self.colour.setdefault(placement[6:], move)
+            self.arrivals.setdefault(move.to_square, []).append((order, move, occupancy))
+            if is_capture:
+                self.departures.setdefault(move.from_square, []).append((order, move, occupancy))
+
+    # The moves listed under any of the squares in `squares`, back in `legal_moves` order.
+    @staticmethod
+    def touching(moves: Dict[int, List[Tuple[int, chess.Move, int]]], squares: int) -> List[Tuple[int, chess.Move, int]]:
+        return sorted(entry for sq in chess.scan_forward(squares) for entry in moves.get(sq, ()))
+
+# Indices are cached per position, so that repeated frames of the same position
+# (and positions revisited after an undo) do not rebuild them.
+MOVE_INDEX_CACHE_SIZE = 256
+MOVE_INDEX_CACHE: OrderedDict[tuple, MoveIndex] = OrderedDict()
+MOVE_INDEX_LOCK = threading.Lock()
+
+def position_key(b: chess.Board) -> tuple:
+    return board_placement(b), b.turn, b.castling_rights, b.ep_square
+
+def move_index(b: chess.Board) -> MoveIndex:
+    key = position_key(b)
+    with MOVE_INDEX_LOCK:
+        index = MOVE_INDEX_CACHE.get(key)
+        if index is not None:
+            MOVE_INDEX_CACHE.move_to_end(key)
+            return index
+    index = MoveIndex(b)
+    with MOVE_INDEX_LOCK:
+        MOVE_INDEX_CACHE[key] = index
+        while len(MOVE_INDEX_CACHE) > MOVE_INDEX_CACHE_SIZE:
+            MOVE_INDEX_CACHE.popitem(last=False)
+    return index
+
+# Builds the index for a position ahead of time (e.g. straight after a move is pushed),
+# so that it is ready before the next frame of that position arrives.
+def prime_move_index(b: chess.Board):
+    move_index(b)
+
+# Zobrist keys for hashing piece placements: one random 64-bit key per square and piece
+# (pawn to king for white, then for black), XORed together over the occupied squares.
+# The generator is seeded so that hashes are stable across runs.
+ZOBRIST_RANDOM = random.Random(0x5A0B)
+ZOBRIST_KEYS = [[ZOBRIST_RANDOM.getrandbits(64) for _ in range(12)] for _ in range(64)]
+
+def square_key(p: Placement, sq: int) -> int:
+    bit = chess.BB_SQUARES[sq]
+    for piece_type in range(6):
+        if p[piece_type] & bit:
+            return ZOBRIST_KEYS[sq][piece_type + (0 if p[6] & bit else 6)]
+    return 0
+
+def placement_hash(p: Placement) -> int:
+    h = 0
+    for sq in chess.scan_forward(p[6] | p[7]):
+        h ^= square_key(p, sq)
+    return h
+
+# Only the squares whose contents differ between the two placements are rehashed,
+# which for a single move is two to four squares.
+def update_placement_hash(h: int, before: Placement, after: Placement) -> int:
+    changed = 0
+    for a, b in zip(before, after):
+        changed |= a ^ b
+    for sq in chess.scan_forward(changed):
+        h ^= square_key(before, sq) ^ square_key(after, sq)
+    return h
+
+# The piece placement after every ply of a game, indexed by its Zobrist hash,
+# so that a reading can be matched against every earlier position of the game at once.
+# It must be kept in step with the board's move stack through `push`, `pop` and `reset`.
+class PositionHistory:
+    def __init__(self, b: chess.Board):
+        self.reset(b)
+
+    def reset(self, b: chess.Board):
+        replay = b.root()
+        self.placements: List[Placement] = []
+        self.hashes: List[int] = []
+        self.plies: Dict[int, List[int]] = {}
+        placement = board_placement(replay)
+        self.append(placement, placement_hash(placement))
+        for move in b.move_stack:
+            replay.push(move)
+            self.push(replay)
+
+    def append(self, placement: Placement, h: int):
+        self.plies.setdefault(h, []).append(len(self.placements))
+        self.placements.append(placement)
+        self.hashes.append(h)
+
+    # Records the position of `b` straight after a move has been pushed onto it.
+    def push(self, b: chess.Board):
+        placement = board_placement(b)
+        self.append(placement, update_placement_hash(self.hashes[-1], self.placements[-1], placement))
+
+    def pop(self):
+        h = self.hashes.pop()
+        self.placements.pop()
+        plies = self.plies[h]
+        plies.pop()
+        if not plies:
+            del self.plies[h]
+
+    # The most recent earlier ply (before the current one) whose placement is exactly the reading, if any.
+    def earlier_ply(self, pl: List[Optional[chess.Piece]]) -> Optional[int]:
+        placement = list_placement(pl)
+        current = len(self.placements) - 1
+        for ply in reversed(self.plies.get(placement_hash(placement), [])):
+            # Hash collisions are ruled out by comparing the placements themselves.
+            if ply < current and self.placements[ply] == placement:
+                return ply
+        return None
+
 # The second item of the return tuple is whether an exact match was detected or not.
+@timed('match')
 def find_valid_move(
         prev_state: chess.Board,
         new_state: List[Optional[chess.Piece]]) -> Tuple[Optional[chess.Move], bool]:
-    prev_piece_list = piece_list(prev_state)
+    index = move_index(prev_state)
+    pred_placement = list_placement(new_state)
 
     # Firstly, if the pieces are detected to be exactly the same,
     # we register that no move has been made.
-    if prev_piece_list == new_state:
+    if index.placement == pred_placement:
         return None, True
 
     # Next, we check if there exists a legal move that can be made
     # that will give us exactly what we see right now.
-    for move in prev_state.legal_moves:
-        prev_state.push(move)
-        match_found = piece_list(prev_state) == new_state
-        prev_state.pop()
-        if match_found:
-            return move, True
+    move = index.exact.get(pred_placement)
+    if move is not None:
+        return move, True
 
     # Now, we check whether the occupancies are about the same.
     # We consider "about the same" to be if the predicted piece colours
     # in each square are the same.
-    prev_state_colour = colour_list(prev_piece_list)
-    new_state_colour = colour_list(new_state)
-
     # If the colours are seen to be the same, we consider no move being made.
-    if prev_state_colour == new_state_colour:
+    if index.placement[6:] == pred_placement[6:]:
         return None, False
 
     # Next, we check if there is a legal move that can achieve this form.
     # We assume the first one we see is the only possible one,
     # since each move will have a unique start and end point.
-    for move in prev_state.legal_moves:
-        prev_state.push(move)
-        match_found = colour_list(piece_list(prev_state)) == new_state_colour
-        prev_state.pop()
-        if match_found:
-            return move, False
+    move = index.colour.get(pred_placement[6:])
+    if move is not None:
+        return move, False
 
     # If the stricter checking did not work previously,
     # we now focus only on piece presence rather than piece type.
-    true = full_occupancy(prev_state_colour)
-    pred = full_occupancy(new_state_colour)
+    true = index.placement[6] | index.placement[7]
+    pred = pred_placement[6] | pred_placement[7]
 
     # Firstly, if the predicted occupancy set is a subset of the true occupancy,
     # we check whether either a capture happened or no move happened.
-    if pred <= true:
-        # Only consider captures here.
-        for move in prev_state.legal_moves:
-            if prev_state.piece_at(move.to_square) is not None:
-                prev_state.push(move)
-                possible_occ = full_occupancy(colour_list(piece_list(prev_state)))
-                prev_state.pop()
-                if pred <= possible_occ:
-                    return move, False
+    if pred & ~true == 0:
+        # Only consider captures here, and only those from a square that has since emptied.
+        for _, move, possible_occ in MoveIndex.touching(index.departures, true & ~pred):
+            if pred & ~possible_occ == 0:
+                return move, False
         return None, False
 
-    # Next, we keep track of all the possible squares that can be moved to.
-    allowed_destinations = {m.to_square for m in prev_state.legal_moves}
-
-    new_pieces = pred - true
-    if len(new_pieces) == 1:
+    new_pieces = pred & ~true
+    if chess.popcount(new_pieces) == 1:
         # If there is exactly one square which has a new piece that previously did not have one,
         # we check all legal moves and make the move if the vacancies match or if only one is possible.
-        dest = new_pieces.pop()
-        if dest not in allowed_destinations:
+        dest = chess.lsb(new_pieces)
+        if dest not in index.arrivals:
             raise MoveImpossibleException(f'No piece can move to {sqn(dest)}')
-        possible_origins = {m.from_square for m in prev_state.legal_moves if m.to_square == dest}
+        possible_origins = {move.from_square for _, move, _ in index.arrivals[dest]}
         if len(possible_origins) == 1:
-            return chess.Move(possible_origins.pop(), dest), False
-        vacant_squares = possible_origins - pred
+            return chess.Move(next(iter(possible_origins)), dest), False
+        vacant_squares = {sq for sq in possible_origins if not pred & chess.BB_SQUARES[sq]}
         if len(vacant_squares) == 1:
             return chess.Move(vacant_squares.pop(), dest), False
         else:
@@ -101,12 +250,77 @@ def find_valid_move(
     else:
         # Otherwise, if there are multiple differences, we check to see whether the
         # characteristics of the possible positions match.
-        for move in prev_state.legal_moves:
-            prev_state.push(move)
-            possible_occ = full_occupancy(colour_list(piece_list(prev_state)))
-            prev_state.pop()
-            if pred <= possible_occ:
+        # Only a move landing on one of the newly occupied squares can cover it.
+        for _, move, possible_occ in MoveIndex.touching(index.arrivals, new_pieces):
+            if pred & ~possible_occ == 0:
                 return move, False
 
     # If the above could not resolve a move, then multiple pieces must have been shuffled and disoriented.
     raise MoveImpossibleException('No legal move found for this transition')
+
+# An upper bound on how many squares of `colour` can change occupancy within `plies` half-moves:
+# each move by that side changes at most two of its squares (four when castling),
+# and each move by the other side removes at most one of them by capturing.
+def colour_change_bound(b: chess.Board, colour: chess.Color, plies: int) -> int:
+    own = (plies + (b.turn == colour)) // 2
+    per_move = 4 if b.has_castling_rights(colour) else 2
+    return own * per_move + (plies - own)
+
+# For when several moves were played between two reads of the board (e.g. both players moved
+# while the board was obstructed), this searches sequences of two up to `max_plies` legal moves
+# for the ones that produce the reading, shortest sequences first.
+# Branches that can no longer reach the reading's occupancy are pruned using the bounds above,
+# and the last move of a sequence is only drawn from moves between squares that still differ.
+# A sequence giving exactly the reading is preferred over one matching only its colours,
+# and the second item of the return tuple is again whether the match was exact.
+# From three moves on, most readings can be reached in more than one order (e.g. e4 e5 Nf3 and Nf3 e5 e4).
+# If every matching sequence ends in the same position, the first one found is returned,
+# but as an inexact match since the order it was played in is only a guess.
+@timed('search')
+def find_move_sequence(
+        prev_state: chess.Board,
+        new_state: List[Optional[chess.Piece]],
+        max_plies: int = 2) -> Tuple[List[chess.Move], bool]:
+    pred_placement = list_placement(new_state)
+    board = prev_state.copy()
+    # The sequences found so far, keyed by the position they end in.
+    exact_matches: Dict[tuple, List[List[chess.Move]]] = {}
+    colour_matches: Dict[tuple, List[List[chess.Move]]] = {}
+    sequence: List[chess.Move] = []
+
+    def search(plies: int):
+        placement = board_placement(board)
+        white_diff = placement[6] ^ pred_placement[6]
+        black_diff = placement[7] ^ pred_placement[7]
+        if plies == 0:
+            if not white_diff | black_diff:
+                matches = exact_matches if placement == pred_placement else colour_matches
+                ep_square = board.ep_square if board.has_legal_en_passant() else None
+                matches.setdefault((placement, board.castling_rights, ep_square), []).append(sequence.copy())
+            return
+        if (chess.popcount(white_diff) > colour_change_bound(board, chess.WHITE, plies)
+                or chess.popcount(black_diff) > colour_change_bound(board, chess.BLACK, plies)):
+            return
+        if plies == 1:
+            diff = white_diff | black_diff
+            moves = board.generate_legal_moves(from_mask=diff, to_mask=diff)
+        else:
+            moves = board.generate_legal_moves()
+        for move in moves:
+            board.push(move)
+            sequence.append(move)
+            search(plies - 1)
+            sequence.pop()
+            board.pop()
+
+    for plies in range(2, max_plies + 1):
+        search(plies)
+        for matches, exact in ((exact_matches, True), (colour_matches, False)):
+            if len(matches) == 1:
+                (sequences,) = matches.values()
+                return sequences[0], exact and len(sequences) == 1
+            if len(matches) > 1:
+                raise MoveImpossibleException(
+                    f'{len(matches)} different positions could have been reached in {plies} moves')
+
+    raise MoveImpossibleException(f'No sequence of up to {max_plies} legal moves found for this transition')
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import cv2
+import math
+import numpy as np
+import threading
+import time
+from typing import Callable, Iterator, Optional, Tuple
+
+from server.metrics import time_stage
+
+# The boundary separating parts of the `multipart/x-mixed-replace` MJPEG response.
+MJPEG_BOUNDARY = 'frame'
+MJPEG_MIMETYPE = f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}'
+
+def encode_jpeg(frame: np.ndarray, quality: int = 70, scale: float = 1.0) -> bytes:
+    if scale != 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, blob = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return blob.tobytes()
+
+# Snaps the client's requested quality and scale to a few steps,
+# so that arbitrary query strings cannot create an unbounded number of stream variants.
+def stream_variant(quality: int, scale: float) -> Tuple[int, float]:
+    quality = min(max(round(quality / 10) * 10, 10), 100)
+    scale = min(max(round(scale * 4) / 4, 0.25), 1.0) if math.isfinite(scale) else 1.0
+    return quality, scale
+
+# Limits the client's requested frame rate to between 1 and 30 frames per second,
+# so that a zero, negative or non-finite rate cannot stall the stream or spin it without sleeping.
+def stream_rate(fps: float) -> float:
+    return min(max(fps, 1.0), 30.0) if math.isfinite(fps) else 10.0
+
+def mjpeg_part(jpeg: bytes) -> bytes:
+    header = f'--{MJPEG_BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n'
+    return header.encode() + jpeg + b'\r\n'
+
+# Remembers the last JPEG encoded for each stream variant (source, quality, scale),
+# so that any number of viewers of the same stream share a single encode per frame.
+# Only the `max_entries` most recently used variants are kept.
+class JpegCache:
+    def __init__(self, max_entries: int = 64):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.encoded: OrderedDict[tuple, Tuple[float, bytes]] = OrderedDict()
+
+    def get(self, key: tuple, timestamp: float, frame: Callable[[], np.ndarray], quality: int, scale: float) -> bytes:
+        with self.lock:
+            cached = self.encoded.get(key)
+            if cached is not None:
+                self.encoded.move_to_end(key)
+        if cached is not None and cached[0] == timestamp:
+            return cached[1]
+        image = frame()
+        with time_stage('encode-jpeg'):
+            jpeg = encode_jpeg(image, quality, scale)
+        with self.lock:
+            self.encoded[key] = (timestamp, jpeg)
+            self.encoded.move_to_end(key)
+            while len(self.encoded) > self.max_entries:
+                self.encoded.popitem(last=False)
+        return jpeg
+
+# Yields MJPEG parts for as long as the client stays connected.
+# `next_frame` returns the (timestamp, frame) pair to show, with the frame as a callable
+# so that it is only produced (and encoded) when the timestamp has changed since the last part sent.
+def mjpeg_stream(
+        next_frame: Callable[[], Tuple[float, Callable[[], np.ndarray]]],
+        cache: JpegCache,
+        key: tuple,
+        quality: int = 70,
+        scale: float = 0.5,
+        fps: float = 10.0) -> Iterator[bytes]:
+    interval = 1 / fps
+    last_timestamp: Optional[float] = None
+    while True:
+        started = time.monotonic()
+        timestamp, frame = next_frame()
+        if timestamp != last_timestamp:
+            last_timestamp = timestamp
+            yield mjpeg_part(cache.get(key, timestamp, frame, quality, scale))
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
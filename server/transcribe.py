@@ -0,0 +1,310 @@
+# Offline transcription of recorded games into PGN, without the web UI or the image server.
+# Run from the repository root, for example:
+#
+#   python -m server.transcribe fide2023-game18 fide2024-game14 --output pgns
+#
+# Each argument is a folder of frames of one game, named in playing order (laid out as for `demo/image_server.py`),
+# starting from the initial position. Every frame is read and matched against the game so far,
+# exactly as the `/continue` endpoint does for live frames, and the moves found are written to `<folder>.pgn`.
+#
+# Within a game, frames are decoded and read on a pool of threads whose model calls are batched together
+# by an `InferenceScheduler`, while moves are matched strictly in frame order.
+# Only a bounded window of frames is in flight at once, so memory stays flat however long the game is.
+# Several games are transcribed at once across a pool of processes, each with its own copy of the model,
+# and each game's PGN is written (and reported) as soon as it is finished.
+#
+# Arguments may also be video files of whole games. Videos are decoded sequentially (on a separate thread),
+# sampled at `--sample-fps`, and passed through a `MotionGate` tuned in seconds rather than frames,
+# so that the model only runs on keyframes where the board has settled after a change
+# (typically one sampled frame in several hundred of the video).
+# Each move in the PGN is annotated with the time into the video at which it was seen, as `[%ts h:mm:ss]`.
+# Up to `--max-plies` moves are recovered from a single reading, so moves made between sampled frames are not lost.
+
+import argparse
+import chess
+import chess.pgn
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import cv2
+import json
+import numpy as np
+import os
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from server.api import match_reading, read_board
+from server.batching import InferenceScheduler
+from server.detector import Detector, load_detector
+from server.gate import MotionGate
+from server.read import BoardReader
+from server.types import *
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
+
+# The summary of one transcribed game, as reported on standard output.
+# `frames` counts every frame considered, and `inferred` those that were actually run through the model.
+Transcript = namedtuple('Transcript', ['game', 'pgn', 'frames', 'inferred', 'moves', 'skipped', 'result', 'seconds'])
+
+def frame_paths(folder: str) -> List[str]:
+    names = sorted(f for f in os.listdir(folder) if f.lower().endswith(IMAGE_EXTENSIONS))
+    return [os.path.join(folder, name) for name in names]
+
+# The board readings of a sequence of frames, in order.
+# Each frame is loaded and read on `pool`, with at most `window` frames in flight at a time.
+# A reading is `None` if its frame could not be loaded or the board could not be found on it.
+def board_readings(
+        model: Detector,
+        frames: Iterable[Callable[[], Optional[np.ndarray]]],
+        pool: ThreadPoolExecutor,
+        window: int) -> Iterator[Optional[List[Optional[chess.Piece]]]]:
+    # Each worker thread keeps its own reader, so the board geometry learned from one frame is reused
+    # for later frames on the same thread without being shared between threads.
+    readers = threading.local()
+
+    def read(load: Callable[[], Optional[np.ndarray]]) -> Optional[List[Optional[chess.Piece]]]:
+        image = load()
+        if image is None:
+            return None
+        if not hasattr(readers, 'reader'):
+            readers.reader = BoardReader()
+        try:
+            reading, _ = read_board(model, image, readers.reader)
+        except ImageConversionException:
+            return None
+        return reading
+
+    in_flight: deque[Future] = deque()
+    for load in frames:
+        in_flight.append(pool.submit(read, load))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+# Replays the readings against a game from the initial position, registering moves as the server does
+# (up to `max_plies` of them per reading).
+# Returns the final board, the number of frames, and how many of them were skipped (unreadable or unmatchable).
+def replay_readings(
+        readings: Iterable[Optional[List[Optional[chess.Piece]]]],
+        max_plies: int = 1) -> Tuple[chess.Board, int, int]:
+    board = chess.Board()
+    frames = skipped = 0
+    for reading in readings:
+        frames += 1
+        if reading is None:
+            skipped += 1
+            continue
+        try:
+            moves, _ = match_reading(board, reading, max_plies=max_plies)
+        except (MoveIllegalException, MoveImpossibleException):
+            skipped += 1
+            continue
+        for move in moves:
+            board.push(move)
+    return board, frames, skipped
+
+def format_timestamp(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
+
+# `timestamps`, if given, holds the time into the recording at which each move was seen.
+def write_pgn(board: chess.Board, name: str, path: str, timestamps: Optional[List[float]] = None):
+    game = chess.pgn.Game.from_board(board)
+    game.headers['Event'] = name
+    game.headers['Annotator'] = 'MemoChess'
+    if timestamps is not None:
+        for node, timestamp in zip(game.mainline(), timestamps):
+            node.comment = f'[%ts {format_timestamp(timestamp)}]'
+    with open(path, 'w') as f:
+        print(game, file=f, end='\n\n')
+
+# The model loaded by each worker process (or by the main process when there is only one game at a time).
+WORKER_MODEL: Optional[InferenceScheduler] = None
+WORKER_OPTIONS = {}
+
+def init_worker(
+        model_path: str,
+        threads: Optional[int],
+        batch_size: int,
+        workers: int,
+        sample_fps: float,
+        settle_seconds: float,
+        max_plies: int):
+    global WORKER_MODEL
+    # Frames in flight are already bounded by the window, so none are ever refused.
+    WORKER_MODEL = InferenceScheduler(
+        load_detector(model_path, threads=threads), max_batch_size=batch_size, max_pending=None)
+    WORKER_OPTIONS['workers'] = workers
+    WORKER_OPTIONS['window'] = 2 * max(batch_size, workers)
+    WORKER_OPTIONS['sample_fps'] = sample_fps
+    WORKER_OPTIONS['settle_seconds'] = settle_seconds
+    WORKER_OPTIONS['max_plies'] = max_plies
+
+def transcribe_frames(
+        name: str,
+        frames: Iterable[Callable[[], Optional[np.ndarray]]],
+        output: str) -> Transcript:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKER_OPTIONS['workers'], thread_name_prefix=f'read-{name}') as pool:
+        readings = board_readings(WORKER_MODEL, frames, pool, WORKER_OPTIONS['window'])
+        board, frame_count, skipped = replay_readings(readings, WORKER_OPTIONS['max_plies'])
+    pgn_path = os.path.join(output, f'{name}.pgn')
+    write_pgn(board, name, pgn_path)
+    return Transcript(
+        game=name,
+        pgn=pgn_path,
+        frames=frame_count,
+        inferred=frame_count,
+        moves=len(board.move_stack),
+        skipped=skipped,
+        result=board.result(),
+        seconds=time.perf_counter() - start)
+
+def transcribe_folder(folder: str, output: str) -> Transcript:
+    name = os.path.basename(os.path.normpath(folder))
+    frames = (lambda path=path: cv2.imread(path) for path in frame_paths(folder))
+    return transcribe_frames(name, frames, output)
+
+# Runs `frames` on a background thread, keeping at most `size` items ready ahead of the consumer,
+# so that decoding overlaps with inference.
+def prefetch(frames: Iterator, size: int) -> Iterator:
+    ready = queue.Queue(maxsize=size)
+    finished = object()
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in frames:
+                while not stopped.is_set():
+                    try:
+                        ready.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stopped.is_set():
+                    return
+        finally:
+            if not stopped.is_set():
+                ready.put(finished)
+
+    thread = threading.Thread(target=produce, name='decode', daemon=True)
+    thread.start()
+    try:
+        while (item := ready.get()) is not finished:
+            yield item
+    finally:
+        stopped.set()
+
+# The frames of a video sampled at `sample_fps`, with their times (in seconds) into the video.
+# Skipped frames are only grabbed (demuxed and decoded), never converted into images.
+def video_frames(path: str, sample_fps: float) -> Iterator[Tuple[float, np.ndarray]]:
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise OSError(f'Could not open video {path}')
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        step = max(1, round(fps / sample_fps))
+        index = 0
+        while capture.grab():
+            if index % step == 0:
+                ret, frame = capture.retrieve()
+                if ret:
+                    yield index / fps, frame
+            index += 1
+    finally:
+        capture.release()
+
+def transcribe_video(path: str, output: str) -> Transcript:
+    start = time.perf_counter()
+    name = os.path.splitext(os.path.basename(path))[0]
+    sample_fps = WORKER_OPTIONS['sample_fps']
+    # The board counts as settled once it has looked the same for `settle_seconds`.
+    gate = MotionGate(stable_frames=max(1, round(WORKER_OPTIONS['settle_seconds'] * sample_fps)))
+    reader = BoardReader()
+    # Frames are read one at a time, so they go straight to the detector rather than through the scheduler.
+    model = WORKER_MODEL.detector
+
+    board = chess.Board()
+    timestamps = []
+    frames = inferred = skipped = 0
+    for timestamp, frame in prefetch(video_frames(path, sample_fps), WORKER_OPTIONS['window']):
+        frames += 1
+        if gate.observe(frame) != GateDecision.Inferred:
+            continue
+        inferred += 1
+        try:
+            reading, _ = read_board(model, frame, reader)
+            # The keyframe is only accepted once it has been read, so an obstructed board is retried on later frames.
+            gate.record(reading, reader.geometry.region())
+            moves, _ = match_reading(board, reading, max_plies=WORKER_OPTIONS['max_plies'])
+        except (ImageConversionException, MoveIllegalException, MoveImpossibleException):
+            skipped += 1
+            continue
+        for move in moves:
+            board.push(move)
+            timestamps.append(timestamp)
+
+    pgn_path = os.path.join(output, f'{name}.pgn')
+    write_pgn(board, name, pgn_path, timestamps)
+    return Transcript(
+        game=name,
+        pgn=pgn_path,
+        frames=frames,
+        inferred=inferred,
+        moves=len(board.move_stack),
+        skipped=skipped,
+        result=board.result(),
+        seconds=time.perf_counter() - start)
+
+def transcribe(game: str, output: str) -> Transcript:
+    if game.lower().endswith(VIDEO_EXTENSIONS):
+        return transcribe_video(game, output)
+    return transcribe_folder(game, output)
+
+def main():
+    parser = argparse.ArgumentParser(description='Transcribe recorded games into PGN files.')
+    parser.add_argument('games', nargs='+', help='folders of frames or video files, one per game')
+    parser.add_argument('--output', default='.', help='folder to write the PGN files into')
+    parser.add_argument('--model', default=os.environ.get('MEMOCHESS_MODEL', 'models/trained_yolo11m-v0-1-0.pt'),
+                        help='model weights, exported .onnx file or OpenVINO model directory')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='games transcribed at once, each in its own process (default: up to 4)')
+    parser.add_argument('--batch-size', type=int, default=8, help='frames per forward pass of the model')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='threads decoding and reading frames per game (default: the batch size)')
+    parser.add_argument('--sample-fps', type=float, default=2.0, help='frames per second of video to consider')
+    parser.add_argument('--settle-seconds', type=float, default=1.0,
+                        help='how long the board must look unchanged in a video before it is read')
+    parser.add_argument('--max-plies', type=int, default=2,
+                        help='most moves registered from one reading, for moves made between sampled frames')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    cpus = os.cpu_count() or 1
+    jobs = min(args.jobs or min(4, cpus), len(args.games))
+    # The cores are split evenly between the processes, so that their inference threads do not contend.
+    threads = max(1, cpus // jobs)
+    worker_options = (
+        args.model, threads, args.batch_size, args.workers or args.batch_size, args.sample_fps, args.settle_seconds,
+        args.max_plies)
+
+    def report(transcript: Transcript):
+        print(json.dumps(transcript._asdict()), flush=True)
+
+    if jobs == 1:
+        init_worker(*worker_options)
+        for game in args.games:
+            report(transcribe(game, args.output))
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=worker_options) as pool:
+        futures = [pool.submit(transcribe, game, args.output) for game in args.games]
+        for future in as_completed(futures):
+            report(future.result())
+
+if __name__ == '__main__':
+    main()
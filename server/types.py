@@ -19,10 +19,35 @@ class MoveIllegalException(Exception):
 class MoveImpossibleException(Exception):
     pass
 
+# This exception is thrown when inference is already saturated,
+# so the frame is dropped rather than queued behind the frames already waiting.
+class InferenceBusyException(Exception):
+    pass
+
+# This exception is thrown when the live board does not follow from the current position,
+# but matches an earlier position of the game exactly, so the moves since then could be taken back.
+# Its arguments are a message and the ply of that earlier position.
+class EarlierPositionException(Exception):
+    pass
+
+# This exception is thrown when a new board is asked for,
+# but the server is already tracking as many boards as it allows, all of them in use.
+class SessionLimitException(Exception):
+    pass
+
 GameResumeOutcome = Enum('GameResumeOutcome', [
     'ExactMatch',
     'InexactMatch',
     'PossibleMoveMade',
 ])
 
-MoveState = namedtuple('MoveState', ['move', 'exact', 'error'])
+# The decision made by the motion gate before running inference on a frame.
+GateDecision = Enum('GateDecision', [
+    'Inferred',
+    'Unchanged',
+    'InMotion',
+])
+
+# `gate` records whether the reading behind this state came from a fresh inference,
+# or whether inference was skipped because the scene was unchanged or still in motion.
+MoveState = namedtuple('MoveState', ['move', 'exact', 'error', 'gate'], defaults=['inferred'])
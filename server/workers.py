@@ -0,0 +1,255 @@
+import atexit
+from functools import partial
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import os
+import queue
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from server.detector import Detections, Detector, load_detector, plot_detections
+from server.types import InferenceBusyException
+
+# A pool of inference processes, each of which loads the detector once.
+#
+# Flask serves every board from one process, where the GIL and a single model instance
+# leave most cores idle once several boards are live. With the pool, each detection request
+# is handed to an idle worker process, so as many requests as there are workers run truly in parallel.
+# Frames are written into a shared memory segment owned by the front process (one per worker),
+# and only their slot and shape are sent to the worker, so frames are never pickled.
+# Only the compact detection arrays come back; drawing the annotated image stays in the front process,
+# along with all board and session state.
+#
+# Workers are started with the `spawn` method, so they do not inherit the threads of the server.
+# Note that this means each worker imports the server's main module again when it starts,
+# so a module that creates a pool at import time must not do so inside a worker
+# (`multiprocessing.parent_process()` is only `None` in the front process).
+# A worker that dies is restarted, and the request it was serving is retried once on another worker.
+
+# The default slot size fits a 1080p BGR frame. Larger frames are sent to workers by value instead.
+DEFAULT_SLOT_BYTES = 1920 * 1080 * 3
+
+class WorkerCrashedException(Exception):
+    pass
+
+def slot_view(segment: shared_memory.SharedMemory, slot: int, slot_bytes: int, shape: Tuple[int, ...]) -> np.ndarray:
+    return np.ndarray(shape, dtype=np.uint8, buffer=segment.buf, offset=slot * slot_bytes)
+
+# The entry point of each worker process.
+# Requests are `(request_id, frames, imgsz, conf)` tuples, where each frame is either
+# a `(slot, shape)` pair locating it in the shared segment or, if it did not fit, the array itself.
+# Responses are `(request_id, detections)`, with a `(xywhn, conf, cls)` triple per frame,
+# or `(request_id, exception)` if detection failed. `None` asks the worker to exit.
+def worker_main(
+        model_path: str,
+        threads: Optional[int],
+        cores: Optional[List[int]],
+        segment_name: str,
+        slot_bytes: int,
+        requests: multiprocessing.Queue,
+        responses: multiprocessing.Queue):
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    if threads is not None:
+        # Set before the inference library is first imported (by `load_detector`), so its thread pools honour it.
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+    detector = load_detector(model_path, threads=threads)
+    # Workers share the front process's resource tracker, so the segment is still unlinked only once.
+    segment = shared_memory.SharedMemory(name=segment_name)
+    responses.put(('ready', detector.names))
+
+    try:
+        while (request := requests.get()) is not None:
+            request_id, frames, imgsz, conf = request
+            images = [
+                slot_view(segment, frame[0], slot_bytes, frame[1]) if isinstance(frame, tuple) else frame
+                for frame in frames
+            ]
+            try:
+                detections = detector.detect(images, imgsz=imgsz, conf=conf)
+                responses.put((request_id, [(d.xywhn, d.conf, d.cls) for d in detections]))
+            except Exception as err:
+                responses.put((request_id, err))
+            del images
+    finally:
+        segment.close()
+
+# The front process's handle on one worker process and its shared segment.
+# A worker serves one request at a time; the pool only hands it out while it is idle.
+class InferenceWorker:
+    def __init__(
+            self,
+            index: int,
+            model_path: str,
+            threads: Optional[int],
+            cores: Optional[List[int]],
+            slots: int,
+            slot_bytes: int):
+        self.index = index
+        self.model_path = model_path
+        self.threads = threads
+        self.cores = cores
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.segment = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+        self.context = multiprocessing.get_context('spawn')
+        self.names: Dict[int, str] = {}
+        self.frames = 0
+        self.restarts = 0
+        self.next_request_id = 0
+        self.start()
+
+    def start(self):
+        # Fresh queues each time, since a process that died mid-request may have left them inconsistent.
+        self.requests = self.context.Queue()
+        self.responses = self.context.Queue()
+        self.process = self.context.Process(
+            target=worker_main,
+            args=(self.model_path, self.threads, self.cores, self.segment.name, self.slot_bytes,
+                  self.requests, self.responses),
+            name=f'inference-worker-{self.index}',
+            daemon=True)
+        self.process.start()
+
+    # Blocks until the worker has loaded its model.
+    def wait_ready(self, timeout: float):
+        message, names = self.receive(timeout)
+        if message != 'ready':
+            raise WorkerCrashedException(f'Worker {self.index} sent {message!r} before it was ready')
+        self.names = names
+
+    def restart(self, timeout: float):
+        self.restarts += 1
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.start()
+        self.wait_ready(timeout)
+
+    # Waits for the next response, checking periodically that the worker is still alive.
+    def receive(self, timeout: Optional[float] = None) -> Tuple[Any, Any]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self.responses.get(timeout=1.0)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise WorkerCrashedException(
+                        f'Worker {self.index} exited with code {self.process.exitcode}')
+                if deadline is not None and time.monotonic() > deadline:
+                    raise WorkerCrashedException(f'Worker {self.index} did not respond in time')
+
+    def detect(self, images: List[np.ndarray], imgsz: int, conf: float) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        frames = []
+        for slot, image in enumerate(images):
+            if image.dtype == np.uint8 and image.nbytes <= self.slot_bytes:
+                np.copyto(slot_view(self.segment, slot, self.slot_bytes, image.shape), image)
+                frames.append((slot, image.shape))
+            else:
+                frames.append(image)
+
+        self.next_request_id += 1
+        request_id = self.next_request_id
+        self.requests.put((request_id, frames, imgsz, conf))
+        while True:
+            response_id, result = self.receive()
+            # Responses to requests abandoned before a restart are discarded.
+            if response_id == request_id:
+                break
+        if isinstance(result, Exception):
+            raise result
+        self.frames += len(images)
+        return result
+
+    def close(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.kill()
+        self.segment.close()
+        self.segment.unlink()
+
+class WorkerPool(Detector):
+    def __init__(
+            self,
+            model_path: str,
+            workers: int = 2,
+            threads: Optional[int] = None,
+            pin_cores: bool = True,
+            slots: int = 4,
+            slot_bytes: int = DEFAULT_SLOT_BYTES,
+            startup_timeout: float = 300.0,
+            max_queue_wait: float = 2.0):
+        cpus = os.cpu_count() or 1
+        # By default, the cores are split evenly between the workers.
+        threads = threads or max(1, cpus // workers)
+        self.slots = slots
+        self.startup_timeout = startup_timeout
+        # How long a request may wait for a worker to become idle before it is refused.
+        self.max_queue_wait = max_queue_wait
+        self.workers = []
+        for index in range(workers):
+            cores = [(index * threads + i) % cpus for i in range(threads)] if pin_cores else None
+            self.workers.append(InferenceWorker(index, model_path, threads, cores, slots, slot_bytes))
+        for worker in self.workers:
+            worker.wait_ready(startup_timeout)
+        self.names = self.workers[0].names
+
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        # The shared segments outlive the process unless they are unlinked.
+        atexit.register(self.close)
+
+    def detect(self, images: List[np.ndarray], imgsz: int = 640, conf: float = 0.25) -> List[Detections]:
+        results = []
+        # Batches larger than a worker's slots are split across consecutive requests.
+        for start in range(0, len(images), self.slots):
+            results.extend(self.detect_chunk(images[start:start + self.slots], imgsz, conf))
+        return [
+            Detections(
+                xywhn=xywhn,
+                conf=confs,
+                cls=cls,
+                names=self.names,
+                plot=partial(plot_detections, image, xywhn, confs, cls, self.names))
+            for image, (xywhn, confs, cls) in zip(images, results)
+        ]
+
+    def detect_chunk(self, images: List[np.ndarray], imgsz: int, conf: float) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        for attempt in range(2):
+            try:
+                worker = self.idle.get(timeout=self.max_queue_wait)
+            except queue.Empty:
+                raise InferenceBusyException(f'No inference worker became idle in {self.max_queue_wait}s')
+            try:
+                return worker.detect(images, imgsz, conf)
+            except WorkerCrashedException:
+                worker.restart(self.startup_timeout)
+                if attempt == 1:
+                    raise
+            finally:
+                self.idle.put(worker)
+
+    def statistics(self) -> Dict[str, Any]:
+        return {
+            'workers': [
+                {
+                    'pid': worker.process.pid,
+                    'alive': worker.process.is_alive(),
+                    'cores': worker.cores,
+                    'threads': worker.threads,
+                    'frames': worker.frames,
+                    'restarts': worker.restarts,
+                }
+                for worker in self.workers
+            ],
+            'idle_workers': self.idle.qsize(),
+        }
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
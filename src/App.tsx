@@ -13,6 +13,10 @@ import { continuingErrorMsg, resumingErrorMsg } from './utils/errorMessages.ts'
 
 const SERVER_IP = '127.0.0.1:5000'
 const POLLING_INTERVAL = 2000
+const WATCH_INTERVAL = 1000
+// Each physical board is tracked in its own server session, chosen by the `?board=` page parameter.
+const BOARD_ID = new URLSearchParams(window.location.search).get('board') ?? 'default'
+const BOARD_PARAMS = new URLSearchParams({ board: BOARD_ID }).toString()
 
 function App() {
   // State relating to the current game state.
@@ -23,7 +27,6 @@ function App() {
   const [capture, setCapture] = useState(false)
   const [continuing, setContinuing] = useState(false)
   const [webcamUrl, setWebcamUrl] = useState('')
-  const [blobUrl, setBlobUrl] = useState<string | undefined>(undefined)
 
   // State relating to showing miscellaneous information.
   const [showPopUp, setShowPopUp] = useState(false)
@@ -81,7 +84,7 @@ function App() {
 
   // Closure to call the server to remove one move from the move stack.
   const undoLastMoveButton = () => {
-    fetch(`http://${SERVER_IP}/undolastmove`)
+    fetch(`http://${SERVER_IP}/undolastmove?` + BOARD_PARAMS)
       .then(response => response.json())
       .then(json => {
         setMoveList(list => list.slice(0, -1))
@@ -89,9 +92,27 @@ function App() {
       })
   }
 
+  // Closure to call the server to take back every move after the given ply.
+  const rollbackTo = (ply: number, then?: () => void) => {
+    const params = new URLSearchParams({ board: BOARD_ID, ply: String(ply) })
+    fetch(`http://${SERVER_IP}/rollback?` + params.toString())
+      .then(response => response.json())
+      .then(json => {
+        if (!json.valid)
+          return
+        setFen(json.fen)
+        setMoveList(json.moves)
+        then?.()
+      })
+  }
+
+  const rollbackPrompt = (ply: number) => {
+    return `The live board matches the game after half-move ${ply}. Take back the moves played since then?`
+  }
+
   // Closure to reset both the server and the UI state (for logout).
   const resetAll = () => {
-    fetch(`http://${SERVER_IP}/reset`)
+    fetch(`http://${SERVER_IP}/reset?` + BOARD_PARAMS)
       .then(response => response.json())
       .then(json => {
         // Ensure pop up does not appear.
@@ -106,7 +127,6 @@ function App() {
         setPassword('')
         // Reset webcam.
         setWebcamUrl('')
-        setBlobUrl(undefined)
         // Reset game progress.
         setWhitePlayer('')
         setBlackPlayer('')
@@ -122,7 +142,7 @@ function App() {
     if (uciMove === null || uciMove === '')
       return
 
-    const params = new URLSearchParams({ uci: uciMove })
+    const params = new URLSearchParams({ board: BOARD_ID, uci: uciMove })
 
     fetch(`http://${SERVER_IP}/override?` + params.toString())
       .then(response => response.json())
@@ -157,74 +177,41 @@ function App() {
       if (!capture)
         return
 
-      // Provide the webcam IP.
-      const webcamParams = new URLSearchParams({ webcam: webcamUrl })
-
-      if (continuing) {
-
-        // Clear out previous blobs to avoid memory leaks.
-        if (blobUrl !== undefined)
-          URL.revokeObjectURL(blobUrl)
-
-        // If "continuing" a game, we first retrieve the image via `/continue`
-        // and then fetch the move being made via `/lastmove`.
-        // To ensure these fetches are done sequentially, they are nested.
-        fetch(`http://${SERVER_IP}/continue?` + webcamParams.toString())
-          .then(response => response.blob())
-          .then(blob => {
-            // First, we update the camera feed image.
-            setBlobUrl(URL.createObjectURL(blob))
-
-            // This server call is made immediately after `/continue` concludes.
-            fetch(`http://${SERVER_IP}/lastmove`)
-              .then(response => response.json())
-              .then(json => {
-                if (json.error === null) {
-
-                  // Update the board state, then the move if there is a change.
-                  setFen(json.fen)
-                  if (json.move !== null)
-                    setMoveList(list => [...list, json.move])
-
-                  // Update the game outcome (possibly terminate/deactivate if concluded)
-                  if (json.status !== '*') {
-                    setGameOutcome(json.status)
-                    deactivateCamera()
-                    alert(`Game has concluded. Result: ${json.status}.`)
-                  }
-                } else if (json.error[0] !== 'image-conversion') {
-                  // We skip over any frames where the person obstructs board corners.
-                  deactivateCamera()
-                  alert(continuingErrorMsg(json.error))
-                }
-              })
-          })
-
-      } else {
-
-        const falsePositiveMoveDetections = (err: string) => {
-          return err.startsWith('move-illegal')
-            || err === 'move-impossible'
-            || err === 'possible-move-made'
-        }
+      // Provide the board id and webcam IP.
+      const webcamParams = new URLSearchParams({ board: BOARD_ID, webcam: webcamUrl })
 
-        // If not "continuing" a game, we are instead "resuming" from a position.
-        fetch(`http://${SERVER_IP}/resume?` + webcamParams.toString())
-          .then(response => response.json())
-          .then(json => {
-            if (json.error === null || falsePositiveMoveDetections(json.error)) {
-              setContinuing(true)
-            } else if (json.error !== 'image-conversion') {
-              // We skip over any frames where the person obstructs board corners.
-              // If there was an error resuming the board state
-              // (live board does not match, or server error)
-              // then stop the camera feed and log the error.
-              deactivateCamera()
-              alert(resumingErrorMsg(json.error))
-            }
-          })
+      // While "continuing" a game, the server reads the board itself and pushes its events (see below).
+      if (continuing)
+        return
+
+      const falsePositiveMoveDetections = (err: string) => {
+        return err.startsWith('move-illegal')
+          || err === 'move-impossible'
+          || err === 'possible-move-made'
       }
 
+      // If not "continuing" a game, we are instead "resuming" from a position.
+      fetch(`http://${SERVER_IP}/resume?` + webcamParams.toString())
+        .then(response => response.json())
+        .then(json => {
+          if (json.error === null || falsePositiveMoveDetections(json.error)) {
+            setContinuing(true)
+          } else if (json.error === 'rollback-available') {
+            // The live board matches an earlier position of the game, so offer to take back the moves since.
+            // Capture is paused meanwhile, and restarted (resuming from that position) if the user agrees.
+            deactivateCamera()
+            if (confirm(rollbackPrompt(json.ply)))
+              rollbackTo(json.ply, () => setCapture(true))
+          } else if (json.error !== 'image-conversion' && json.error !== 'busy') {
+            // We skip over any frames where the person obstructs board corners.
+            // If there was an error resuming the board state
+            // (live board does not match, or server error)
+            // then stop the camera feed and log the error.
+            deactivateCamera()
+            alert(resumingErrorMsg(json.error))
+          }
+        })
+
     }, POLLING_INTERVAL)
 
     return () => {
@@ -233,6 +220,73 @@ function App() {
 
   }, [capture, continuing])
 
+  // While "continuing" a game, the server runs the recognition loop for this board,
+  // and every move, position change, error and result is pushed to us as a Server-Sent Event.
+  // The browser reconnects by itself if the connection drops, resuming from the last event received.
+  useEffect(() => {
+
+    if (!capture || !continuing)
+      return
+
+    const webcamParams = new URLSearchParams({ board: BOARD_ID, webcam: webcamUrl })
+    webcamParams.set('interval', String(WATCH_INTERVAL / 1000))
+    fetch(`http://${SERVER_IP}/watch?` + webcamParams.toString())
+
+    const events = new EventSource(`http://${SERVER_IP}/events?` + BOARD_PARAMS)
+
+    // The full game state, sent on (re)connecting and whenever moves are taken back.
+    events.addEventListener('fen', event => {
+      const json = JSON.parse(event.data)
+      setFen(json.fen)
+      setMoveList(json.moves)
+    })
+
+    events.addEventListener('move', event => {
+      const json = JSON.parse(event.data)
+      setFen(json.fen)
+      // The ply is used so that a replayed move is not appended twice.
+      setMoveList(list => [...list.slice(0, json.ply - 1), json.san])
+    })
+
+    events.addEventListener('result', event => {
+      const json = JSON.parse(event.data)
+      setGameOutcome(json.status)
+      deactivateCamera()
+      alert(`Game has concluded. Result: ${json.status}.`)
+    })
+
+    events.addEventListener('error', event => {
+      // Connection errors are also reported as `error` events, but without any data.
+      if (!(event instanceof MessageEvent))
+        return
+      const json = JSON.parse(event.data)
+      // We skip over any frames where the person obstructs board corners,
+      // or that the server was too busy to read.
+      if (json.error !== null && json.error[0] === 'rollback-available') {
+        // The server keeps reading the board meanwhile, and our state is updated by the `fen` event that follows.
+        if (confirm(json.error[1] + '\n' + rollbackPrompt(json.error[2])))
+          rollbackTo(json.error[2])
+        else
+          deactivateCamera()
+      } else if (json.error !== null && json.error[0] !== 'image-conversion' && json.error[0] !== 'busy') {
+        deactivateCamera()
+        alert(continuingErrorMsg(json.error))
+      }
+    })
+
+    // The server counts its watchers, so this only stops the loop if no other viewer is still watching.
+    return () => {
+      events.close()
+      fetch(`http://${SERVER_IP}/unwatch?` + BOARD_PARAMS)
+    }
+
+  }, [capture, continuing])
+
+  // While capturing, the live camera feed is streamed from the server as MJPEG.
+  const streamUrl = capture && webcamUrl !== ''
+    ? `http://${SERVER_IP}/stream?` + new URLSearchParams({ board: BOARD_ID, webcam: webcamUrl }).toString()
+    : undefined
+
   // Login prompt (with dummy login details)
   if (username !== 'memochess' || password !== '42028a2025') {
     return (
@@ -292,7 +346,7 @@ function App() {
         {/* Column 1/3: Camera live feed and webcam parameters */}
         <div className="grid grid-col-1 row-span-2">
           <BoardView
-            url={blobUrl}
+            url={streamUrl}
             webcam={webcamUrl}
             updateWebcam={
               (event: React.ChangeEvent<HTMLInputElement>) => {
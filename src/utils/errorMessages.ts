@@ -7,6 +7,11 @@ export function continuingErrorMsg(errorMsg: string[]): string {
       return errorMsg[1] + '\nPlease restore the live board to match MemoChess.'
     case 'move-impossible':
       return 'An impossible move was made.\n' + errorMsg[1] + '\nPlease restore the live board to match MemoChess.'
+    case 'too-many-boards':
+      return 'The server is already tracking as many boards as it can.\nPlease try again later.'
+    case 'inference-failed':
+    case 'recognition-failed':
+      return 'The server could not read the board.\n' + errorMsg[1] + '\nPlease try again.'
     default:
       return `Unknown error occurred: ${errorType}`
   }
@@ -0,0 +1,204 @@
+# Hands-free capture of training images from an IP webcam, pre-labelled by the current model.
+# Run from the repository root, for example:
+#
+#   python -m training.data_collection.auto_capture 192.168.1.20:8080 game-03 --format jpg
+#
+# Unlike `collection.py`, no key has to be pressed per image: one stream is kept open,
+# and a frame is saved whenever the board has changed and then stayed still for `--settle-seconds`
+# (so typically once per move, after the player's hand has left the board).
+# Frames that look the same as the last one saved (by perceptual hash) are dropped,
+# e.g. when a piece is picked up and put back on the same square.
+#
+# Each saved image `NNNN.<format>` gets a `NNNN.txt` alongside it with the model's detections
+# as YOLO annotations (`class x_centre y_centre width height`, normalised), and `classes.txt` lists the class names,
+# so annotators only need to correct the labels rather than draw every box.
+# The board corners among those detections locate the board, and from then on only the board
+# is compared, both for motion and for duplicates (without labels, the whole frame is).
+# Encoding and writing happen on background threads, so capture never waits on the disk.
+# Numbering continues from any images already in the folder, so a session can be resumed.
+
+import argparse
+import cv2
+import numpy as np
+import os
+import queue
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+from server.capture import FrameReader
+from server.detector import Detections, load_detector
+from server.gate import MotionGate
+from server.geometry import BoardGeometry
+from server.read import corner_points
+from server.types import GateDecision, ImageConversionException
+
+# The encoder parameter that `--quality` sets for each image format.
+IMAGE_FORMATS = {
+    'png': cv2.IMWRITE_PNG_COMPRESSION,
+    'jpg': cv2.IMWRITE_JPEG_QUALITY,
+    'webp': cv2.IMWRITE_WEBP_QUALITY,
+}
+
+# A difference hash of `size * size` bits: whether each pixel of a small greyscale thumbnail
+# is brighter than its right neighbour by more than `margin` grey levels. Unlike the motion gate's comparison,
+# this ignores small shifts in exposure, but it must be fine enough for a single moved piece to flip some bits.
+# The margin keeps sensor noise from flipping the bits of flat areas, such as empty squares.
+# On a board crop at the default size of 32, `benchmarks/change_detection.py` measures 5-14 bits flipped per move,
+# and at most 2 from noise alone at typical webcam noise levels (4 at twice that).
+def dhash(image: np.ndarray, size: int, margin: int = 2) -> int:
+    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    thumbnail = cv2.resize(grey, (size + 1, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1] + margin).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def next_index(folder: str) -> int:
+    indices = [int(m.group(1)) for f in os.listdir(folder) if (m := re.fullmatch(r'(\d+)\.\w+', f))]
+    return max(indices, default=-1) + 1
+
+def yolo_labels(xywhn: np.ndarray, cls: np.ndarray) -> str:
+    return ''.join(f'{int(c)} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n' for (x, y, w, h), c in zip(xywhn, cls))
+
+def write_classes(folder: str, names: Dict[int, str]):
+    with open(os.path.join(folder, 'classes.txt'), 'w') as f:
+        f.writelines(f'{names[i]}\n' for i in sorted(names))
+
+# Saves frames on `writers` background threads, with at most `max_pending` frames waiting.
+# Frames put with the model's detections are written along with their pre-labels.
+class FrameWriter:
+    def __init__(
+            self,
+            folder: str,
+            image_format: str,
+            quality: Optional[int],
+            writers: int = 2,
+            max_pending: int = 32):
+        self.folder = folder
+        self.extension = image_format
+        self.params = [] if quality is None else [IMAGE_FORMATS[image_format], quality]
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.errors = 0
+        self.threads = [
+            threading.Thread(target=self.run, name=f'writer-{i}', daemon=True)
+            for i in range(writers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    # Blocks if the writers have fallen `max_pending` frames behind, rather than holding frames without bound.
+    def put(self, index: int, frame: np.ndarray, detections: Optional[Detections] = None):
+        self.pending.put((index, frame, detections))
+
+    def run(self):
+        while (item := self.pending.get()) is not None:
+            index, frame, detections = item
+            stem = os.path.join(self.folder, f'{index:>04}')
+            try:
+                if detections is not None:
+                    with open(f'{stem}.txt', 'w') as f:
+                        f.write(yolo_labels(detections.xywhn, detections.cls))
+                if not cv2.imwrite(f'{stem}.{self.extension}', frame, self.params):
+                    raise OSError(f'Could not write {stem}.{self.extension}')
+            except Exception as err:
+                self.errors += 1
+                print(f'Failed to save frame {index}: {err}', flush=True)
+
+    # Waits for every queued frame to be written.
+    def close(self):
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
+
+# Updates `geometry` from the board corners among `detections`, if enough of them were seen.
+def locate_board(geometry: BoardGeometry, detections: Detections):
+    labels = [detections.names[int(c)] for c in detections.cls]
+    try:
+        geometry.homography(corner_points(detections.xywhn, labels))
+    except ImageConversionException:
+        pass
+
+def capture(args: argparse.Namespace):
+    os.makedirs(args.folder, exist_ok=True)
+    model = None
+    if args.labels:
+        model = load_detector(args.model, threads=args.threads)
+        write_classes(args.folder, model.names)
+    writer = FrameWriter(args.folder, args.format, args.quality, args.writers)
+
+    reader = FrameReader(args.webcam)
+    # The gate's board reading is not used here; recording any reading just marks the frame as the new reference.
+    gate = MotionGate(stable_frames=max(1, round(args.settle_seconds * args.fps)))
+    geometry = BoardGeometry()
+    last_hash: Optional[int] = None
+    index = next_index(args.folder)
+    saved = duplicates = 0
+    interval = 1.0 / args.fps
+    print(f'Capturing from {args.webcam} into {args.folder} (Ctrl+C to stop)', flush=True)
+
+    try:
+        last_timestamp = None
+        while args.limit is None or saved < args.limit:
+            time.sleep(interval)
+            captured = reader.latest(wait=5.0, max_age=5.0)
+            if captured is None:
+                print('No frames from the webcam, waiting...', flush=True)
+                continue
+            if captured.timestamp == last_timestamp:
+                continue
+            last_timestamp = captured.timestamp
+            if gate.observe(captured.frame) != GateDecision.Inferred:
+                continue
+
+            # Inference runs at most once per settled change, so it is done here rather than on the writers.
+            detections = None
+            if model is not None:
+                detections = model.detect([captured.frame], conf=args.conf)[0]
+                locate_board(geometry, detections)
+            region = geometry.region()
+            gate.record([], region)
+
+            h = dhash(captured.frame if region is None else MotionGate.crop(captured.frame, region), args.hash_size)
+            if last_hash is not None and (h ^ last_hash).bit_count() <= args.hash_distance:
+                duplicates += 1
+                continue
+            last_hash = h
+            writer.put(index, captured.frame.copy(), detections)
+            print(f'Captured {index:>04}', flush=True)
+            index += 1
+            saved += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.stop()
+        writer.close()
+        print(f'Saved {saved} frames ({duplicates} near-duplicates dropped, {writer.errors} failed)', flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Automatically capture pre-labelled training images from a webcam.')
+    parser.add_argument('webcam', help='IP webcam address, e.g. 192.168.1.20:8080')
+    parser.add_argument('folder', help='folder to save the images and labels into')
+    parser.add_argument('--format', choices=sorted(IMAGE_FORMATS), default='png', help='image file format')
+    parser.add_argument('--quality', type=int, default=None,
+                        help='JPEG/WebP quality (0-100) or PNG compression level (0-9)')
+    parser.add_argument('--fps', type=float, default=5.0, help='frames per second checked for changes')
+    parser.add_argument('--settle-seconds', type=float, default=1.0,
+                        help='how long the board must stay still after a change before it is captured')
+    parser.add_argument('--hash-size', type=int, default=32,
+                        help='side of the perceptual hash grid (the hash has SIZE*SIZE bits)')
+    parser.add_argument('--hash-distance', type=int, default=3,
+                        help='frames within this many bits of the last saved frame\'s perceptual hash are dropped '
+                             '(-1 keeps every frame)')
+    parser.add_argument('--limit', type=int, default=None, help='stop after saving LIMIT frames')
+    parser.add_argument('--no-labels', dest='labels', action='store_false',
+                        help='skip pre-labelling the frames with the model')
+    parser.add_argument('--model', default=os.environ.get('MEMOCHESS_MODEL', 'models/trained_yolo11m-v0-1-0.pt'),
+                        help='model weights, exported .onnx file or OpenVINO model directory')
+    parser.add_argument('--threads', type=int, default=None, help='inference threads')
+    parser.add_argument('--conf', type=float, default=0.25, help='confidence threshold for pre-labels')
+    parser.add_argument('--writers', type=int, default=2, help='background threads writing frames')
+    capture(parser.parse_args())
+
+if __name__ == '__main__':
+    main()
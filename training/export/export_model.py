@@ -0,0 +1,121 @@
+# Exports the trained `.pt` weights into the formats served by `server/detector.py`.
+# Run from the repository root, for example:
+#
+#   python -m training.export.export_model models/trained_yolo11m-v0-1-0.pt --formats onnx openvino \
+#       --int8 --calibration fide2023-game18
+#
+# FP32 exports are written next to the weights by Ultralytics
+# (`<name>.onnx` and `<name>_openvino_model/`).
+# With `--int8`, each export is additionally quantized using the frames in the calibration folder
+# (`<name>.int8.onnx` and `<name>_int8_openvino_model/`).
+# Calibration frames should be real webcam captures of boards, such as the demo image folders.
+
+import argparse
+import cv2
+import os
+import random
+import shutil
+from typing import Iterator, List
+from ultralytics import YOLO
+
+from server.detector import preprocess
+from server.transcribe import frame_paths
+
+def calibration_images(folder: str, limit: int, seed: int = 19937) -> List[str]:
+    paths = frame_paths(folder)
+    random.Random(seed).shuffle(paths)
+    return paths[:limit]
+
+def calibration_batches(paths: List[str], imgsz: int) -> Iterator:
+    for path in paths:
+        image = cv2.imread(path)
+        if image is not None:
+            yield preprocess([image], imgsz)[0]
+
+def export_onnx(model: YOLO, imgsz: int) -> str:
+    return model.export(format='onnx', dynamic=True, simplify=True, imgsz=imgsz)
+
+def quantize_onnx(fp32_path: str, paths: List[str], imgsz: int) -> str:
+    import onnx
+    from onnxruntime.quantization import (
+        CalibrationDataReader, QuantFormat, QuantType, quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class FrameReader(CalibrationDataReader):
+        def __init__(self, input_name: str):
+            self.input_name = input_name
+            self.batches = calibration_batches(paths, imgsz)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {self.input_name: batch}
+
+    base, _ = os.path.splitext(fp32_path)
+    prepared_path = base + '.prep.onnx'
+    int8_path = base + '.int8.onnx'
+    quant_pre_process(fp32_path, prepared_path, skip_symbolic_shape=True)
+    input_name = onnx.load(prepared_path).graph.input[0].name
+    quantize_static(
+        prepared_path, int8_path, FrameReader(input_name),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8)
+    os.remove(prepared_path)
+
+    # Quantization drops the model metadata, which holds the class names the detector reads back.
+    fp32_model = onnx.load(fp32_path)
+    int8_model = onnx.load(int8_path)
+    onnx.helper.set_model_props(int8_model, {p.key: p.value for p in fp32_model.metadata_props})
+    onnx.save(int8_model, int8_path)
+    return int8_path
+
+def export_openvino(model: YOLO, imgsz: int) -> str:
+    return model.export(format='openvino', dynamic=True, imgsz=imgsz)
+
+def quantize_openvino(fp32_dir: str, paths: List[str], imgsz: int) -> str:
+    import nncf
+    import openvino as ov
+
+    xml_name = next(f for f in os.listdir(fp32_dir) if f.endswith('.xml'))
+    fp32_model = ov.Core().read_model(os.path.join(fp32_dir, xml_name))
+    dataset = nncf.Dataset(list(calibration_batches(paths, imgsz)))
+    int8_model = nncf.quantize(
+        fp32_model, dataset, preset=nncf.QuantizationPreset.MIXED, subset_size=len(paths))
+
+    int8_dir = fp32_dir.rstrip(os.sep).replace('_openvino_model', '_int8_openvino_model')
+    os.makedirs(int8_dir, exist_ok=True)
+    ov.save_model(int8_model, os.path.join(int8_dir, xml_name))
+    shutil.copy(os.path.join(fp32_dir, 'metadata.yaml'), int8_dir)
+    return int8_dir
+
+def main():
+    parser = argparse.ArgumentParser(description='Export YOLO weights for ONNX Runtime and OpenVINO inference.')
+    parser.add_argument('weights', help='path to the trained .pt weights')
+    parser.add_argument('--formats', nargs='+', choices=['onnx', 'openvino'], default=['onnx', 'openvino'])
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--int8', action='store_true', help='also write INT8-quantized models')
+    parser.add_argument('--calibration', help='folder of frames to calibrate INT8 quantization with')
+    parser.add_argument('--calibration-size', type=int, default=300)
+    args = parser.parse_args()
+
+    if args.int8 and args.calibration is None:
+        parser.error('--int8 requires --calibration')
+
+    model = YOLO(args.weights)
+    paths = calibration_images(args.calibration, args.calibration_size) if args.int8 else []
+
+    if 'onnx' in args.formats:
+        onnx_path = export_onnx(model, args.imgsz)
+        print(f'FP32 ONNX model: {onnx_path}')
+        if args.int8:
+            print(f'INT8 ONNX model: {quantize_onnx(onnx_path, paths, args.imgsz)}')
+
+    if 'openvino' in args.formats:
+        openvino_dir = export_openvino(model, args.imgsz)
+        print(f'FP32 OpenVINO model: {openvino_dir}')
+        if args.int8:
+            print(f'INT8 OpenVINO model: {quantize_openvino(openvino_dir, paths, args.imgsz)}')
+
+if __name__ == '__main__':
+    main()